@@ -8,22 +8,22 @@ This script combines expert classification with structure tree creation in one w
 
 import os
 import sys
-import json
 import logging
 from pathlib import Path
-import subprocess
+from typing import Dict
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 
-def tag_pdf(input_pdf: str, output_name: str):
+def tag_pdf(input_pdf: str, output_name: str, save_json: bool = False):
     """
     Automatically tag a PDF with structure tree visible in Acrobat Pro.
     
     Args:
         input_pdf: Path to input (untagged) PDF
         output_name: Name for output files (without .pdf)
+        save_json: Also write accessibility_cache/<output_name>_tags.json (the CLI does)
     
     Returns:
         str: Path to tagged PDF
@@ -35,11 +35,11 @@ def tag_pdf(input_pdf: str, output_name: str):
     
     # Step 1: Generate JSON tags
     logger.info("\n[Step 1/2] Generating expert JSON tags...")
-    json_file = generate_json_tags(input_pdf, output_name)
+    tags_data = generate_json_tags(input_pdf, output_name, save_json)
     
     # Step 2: Create tagged PDF with structure tree
     logger.info("\n[Step 2/2] Creating tagged PDF with MCID structure tree...")
-    tagged_pdf = create_tagged_pdf_from_json(input_pdf, json_file, output_name)
+    tagged_pdf = create_tagged_pdf_from_json(input_pdf, tags_data, output_name)
     
     logger.info("\n" + "="*70)
     logger.info("✅ COMPLETE! Tagged PDF created successfully")
@@ -54,54 +54,33 @@ def tag_pdf(input_pdf: str, output_name: str):
     return tagged_pdf
 
 
-def generate_json_tags(input_pdf: str, output_name: str) -> str:
-    """Generate JSON tags using expert tagger via subprocess"""
+def generate_json_tags(input_pdf: str, output_name: str, save_json: bool = False) -> Dict:
+    """Generate JSON tags in-process with the expert tagger"""
     
-    # Run expert_tagger as subprocess
-    logger.info(f"Running: python expert_pdf_tagger.py \"{input_pdf}\" \"{output_name}\"")
+    # Imported here so the usage/validation path doesn't load Gemini or PyMuPDF
+    from expert_pdf_tagger import generate_tags
     
-    result = subprocess.run(
-        [sys.executable, "expert_pdf_tagger.py", input_pdf, output_name],
-        capture_output=True,
-        text=True,
-        timeout=120  # 2 minute timeout
-    )
+    tags_data = generate_tags(input_pdf, output_name, save_json=save_json)
     
-    if result.returncode != 0:
-        logger.error(f"Error running expert_tagger: {result.stderr}")
-        raise RuntimeError(f"Failed to generate JSON tags: {result.stderr}")
+    if save_json:
+        json_file = Path("accessibility_cache") / f"{output_name}_tags.json"
+        logger.info(f"✓ Generated JSON tags: {json_file}")
+    else:
+        logger.info("✓ Generated JSON tags (in memory)")
     
-    # Check for created files
-    json_file = Path("accessibility_cache") / f"{output_name}_tags.json"
-    
-    if not json_file.exists():
-        logger.error(f"JSON file not created: {json_file}")
-        raise FileNotFoundError(f"JSON tags not created: {json_file}")
-    
-    logger.info(f"✓ Generated JSON tags: {json_file}")
-    
-    return str(json_file)
+    return tags_data
 
 
-def create_tagged_pdf_from_json(input_pdf: str, json_file: str, output_name: str) -> str:
-    """Create tagged PDF from JSON tags using advanced MCID version"""
+def create_tagged_pdf_from_json(input_pdf: str, tags_data: Dict, output_name: str) -> str:
+    """Create tagged PDF from the in-memory JSON tags document"""
+    
+    from create_tagged_pdf_pikepdf import build_tagged_pdf
     
     # Output path
     output_pdf = Path("output") / f"{output_name}_tagged.pdf"
     
-    # Run pikepdf version (no element limit)
-    logger.info(f"Running: python create_tagged_pdf_pikepdf.py \"{input_pdf}\" \"{json_file}\" \"{output_pdf}\"")
-    
-    result = subprocess.run(
-        [sys.executable, "create_tagged_pdf_pikepdf.py", input_pdf, json_file, str(output_pdf)],
-        capture_output=True,
-        text=True,
-        timeout=120  # 2 minute timeout
-    )
-    
-    if result.returncode != 0:
-        logger.error(f"Error creating tagged PDF: {result.stderr}")
-        raise RuntimeError(f"Failed to create tagged PDF: {result.stderr}")
+    # Build with pikepdf (no element limit)
+    build_tagged_pdf(input_pdf, tags_data, str(output_pdf))
     
     logger.info(f"✓ Created tagged PDF with MCID: {output_pdf}")
     
@@ -133,8 +112,8 @@ def main():
         logger.error(f"❌ Input file not found: {input_pdf}")
         sys.exit(1)
     
-    # Create tagged PDF
-    tag_pdf(input_pdf, output_name)
+    # Create tagged PDF (the CLI keeps the JSON tags file)
+    tag_pdf(input_pdf, output_name, save_json=True)
 
 
 if __name__ == "__main__":
@@ -3,16 +3,44 @@ Complete PDF Tagger with Full MCID Content Stream Injection
 Links structure elements to actual PDF content to eliminate pink borders
 """
 
-import json
+import os
 import logging
-from pathlib import Path
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 import pikepdf
-import io
 import re
 
+from pdf_structure_taxonomy import TagType
+from tags_json import load_tags_json
+from pdf_lexer import iter_operators
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Name objects reused for every structure element
+_NAME_STRUCT_TREE_ROOT = pikepdf.Name.StructTreeRoot
+_NAME_STRUCTELEM = pikepdf.Name.StructElem
+_NAME_MCR = pikepdf.Name.MCR
+_NAME_SPAN = pikepdf.Name('/Span')
+_TAG_TYPE_NAMES = {t.value: pikepdf.Name(f'/{t.value}') for t in TagType}
+
+# Whitespace runs collapsed when building descriptions
+_WS_RE = re.compile(r'\s+')
+
+# Operators that paint text inside a BT ... ET block
+_TEXT_SHOW_OPS = frozenset((b'Tj', b'TJ', b"'", b'"'))
+
+# Below this many pages, worker start-up costs more than the rewriting saves
+_PARALLEL_MIN_PAGES = 8
+
+
+def _tag_type_name(tag_type: str):
+    """Name object for a tag type, built once per distinct type and reused"""
+    struct_type = _TAG_TYPE_NAMES.get(tag_type)
+    if struct_type is None:
+        struct_type = _TAG_TYPE_NAMES[tag_type] = pikepdf.Name(f'/{tag_type}')
+    return struct_type
+
 
 def create_complete_tagged_pdf(input_pdf: str, json_tags_file: str, output_pdf: str):
     """Create fully tagged PDF with content linkage via MCID injection"""
@@ -22,81 +50,96 @@ def create_complete_tagged_pdf(input_pdf: str, json_tags_file: str, output_pdf:
     logger.info("="*70)
     
     # Load JSON tags
-    with open(json_tags_file, 'r') as f:
-        data = json.load(f)
+    data = load_tags_json(json_tags_file)
     
     tags = data['document']['structure_tags']
     logger.info(f"Loaded {len(tags)} structure tags")
     
-    # Open PDF
-    pdf = pikepdf.open(input_pdf)
+    # Open PDF (memory-mapped so qpdf pages large inputs in lazily)
+    try:
+        pdf = pikepdf.open(input_pdf, access_mode=pikepdf.AccessMode.mmap)
+    except (OSError, ValueError):
+        pdf = pikepdf.open(input_pdf)
     
     try:
         # 1. Mark as tagged
         pdf.Root['/MarkInfo'] = pikepdf.Dictionary({'/Marked': True})
         logger.info("✓ Marked PDF")
         
-        # 2. Create structure tree root
-        parent_tree_nums = pikepdf.Array([])
-        kids_array = pikepdf.Array([])
-        
-        struct_tree_root = pikepdf.Dictionary({
-            '/Type': pikepdf.Name.StructTreeRoot,
-            '/K': kids_array,
-            '/ParentTree': pikepdf.Dictionary({'/Nums': parent_tree_nums})
-        })
+        # 2. Create structure tree root (kids and parent tree are filled in after the page loop)
+        # Indirect so structure elements can point /P at it when they are created
+        struct_tree_root = pdf.make_indirect(pikepdf.Dictionary({
+            '/Type': _NAME_STRUCT_TREE_ROOT
+        }))
         
         pdf.Root['/StructTreeRoot'] = struct_tree_root
         logger.info("✓ Created /StructTreeRoot")
         
-        # 3. Group tags by page
-        page_tags = {}
-        mcid_counter = 0
+        # 3. Group tags by page (MCID = position among the page's tags)
+        page_tags = defaultdict(list)
         
         for tag in tags:
-            page_num = tag.get('page', 1) - 1
-            if page_num not in page_tags:
-                page_tags[page_num] = []
-            page_tags[page_num].append((mcid_counter, tag))
-            mcid_counter += 1
+            page_tags[tag.get('page', 1) - 1].append(tag)
+        
+        pages = [(page_num, pdf.pages[page_num].obj) for page_num in page_tags
+                 if page_num < len(pdf.pages)]
+        
+        # 4. CRITICAL: Inject MCIDs into content streams first (pages are independent),
+        # so only marked content that really exists is referenced from the tree
+        marked_counts = inject_mcids_for_pages([
+            (page_obj, [tag['type'] for tag in page_tags[page_num]])
+            for page_num, page_obj in pages
+        ])
         
-        # 4. Process each page
+        # 5. Create structure elements. Each page with marked content gets a
+        # /StructParents key whose parent tree entry is an array indexed by MCID.
         all_struct_elements = []
+        parent_tree_nums = []
+        mcid_total = 0
         
-        for page_num, page_element_tags in page_tags.items():
-            if page_num >= len(pdf.pages):
-                continue
+        for (page_num, page_obj), marked in zip(pages, marked_counts):
+            page_element_tags = page_tags[page_num]
+            logger.debug("Processing page %d (%d elements, %d marked)", page_num + 1, len(page_element_tags), marked)
             
-            logger.info(f"\nProcessing Page {page_num + 1}...")
+            page_parents = []
             
-            page = pdf.pages[page_num]
-            page_obj = page.obj
-            
-            # Get all structure elements for this page
-            page_struct_elements = []
-            
-            for mcid, tag in page_element_tags:
-                struct_elem = create_structure_element(pdf, tag, mcid, page_num)
-                page_struct_elements.append((mcid, struct_elem))
-                all_struct_elements.append((mcid, struct_elem))
-                
-                # Add to parent tree
-                parent_tree_nums.append(mcid)
-                parent_tree_nums.append(struct_elem)
+            for mcid, tag in enumerate(page_element_tags):
+                # Tags beyond the page's text blocks have no marked content to reference
+                struct_elem = create_structure_element(pdf, tag, mcid if mcid < marked else None,
+                                                       page_obj, struct_tree_root)
+                all_struct_elements.append(struct_elem)
+                if mcid < marked:
+                    page_parents.append(struct_elem)
                 
-                logger.info(f"  Created structure element: {tag['type']} (MCID: {mcid})")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("  Created structure element: %s (MCID: %s)", tag['type'],
+                                 mcid if mcid < marked else "none")
             
-            # 5. CRITICAL: Inject MCIDs into content stream
-            inject_mcids_for_page(page_obj, page_struct_elements, pdf)
-            
-            # Add structure elements to tree
-            for _, struct_elem in page_struct_elements:
-                kids_array.append(struct_elem)
+            if page_parents:
+                parent_key = len(parent_tree_nums) // 2
+                page_obj['/StructParents'] = parent_key
+                parent_tree_nums.extend((parent_key, pikepdf.Array(page_parents)))
+                mcid_total += len(page_parents)
+        
+        # Build kids and parent tree in one go instead of appending element by element
+        struct_tree_root['/K'] = pikepdf.Array(all_struct_elements)
+        struct_tree_root['/ParentTree'] = pikepdf.Dictionary({
+            '/Nums': pikepdf.Array(parent_tree_nums)
+        })
+        struct_tree_root['/ParentTreeNextKey'] = len(parent_tree_nums) // 2
         
-        logger.info(f"\n✓ Created {len(all_struct_elements)} total structure elements")
+        logger.info("✓ Processed %d pages, %d elements, %d MCIDs", len(pages), len(all_struct_elements), mcid_total)
+        logger.info("  ℹ For full pink border highlighting, manually link content in Acrobat Pro")
         
         # 6. Save
-        pdf.save(output_pdf)
+        pdf.save(
+            output_pdf,
+            compress_streams=True,
+            object_stream_mode=pikepdf.ObjectStreamMode.generate,
+            stream_decode_level=pikepdf.StreamDecodeLevel.none,  # Copy existing streams through as-is
+            fix_metadata_version=False,  # Leave XMP metadata alone, no extra rewrite
+            linearize=False
+        )
         logger.info(f"\n✓ Saved: {output_pdf}")
         
         logger.info("\n" + "="*70)
@@ -107,8 +150,13 @@ def create_complete_tagged_pdf(input_pdf: str, json_tags_file: str, output_pdf:
         pdf.close()
 
 
-def create_structure_element(pdf, tag: dict, mcid: int, page_num: int):
-    """Create structure element with tag type and content description as children"""
+def create_structure_element(pdf, tag: dict, mcid, page_obj, parent):
+    """
+    Create structure element with tag type and content description as children
+    
+    mcid is the element's marked content ID on page_obj, or None when the
+    page has no marked content for it (no MCR is added then).
+    """
     
     tag_type = tag['type']
     content = tag.get('content', '')
@@ -116,112 +164,179 @@ def create_structure_element(pdf, tag: dict, mcid: int, page_num: int):
     # Title should be just the tag type (P, Table, etc.)
     title = tag_type
     
-    # Create MCID dictionary that links to content
-    mcid_dict = pikepdf.Dictionary({
-        '/Type': pikepdf.Name.MCR,  # Marked Content Reference
-        '/MCID': mcid,
-        '/Pg': pdf.pages[page_num].obj  # Link to page object
-    })
+    # Structure type as a name object
+    struct_type = _tag_type_name(tag_type)
+    
+    # The element is made indirect first so its description child can point
+    # back at it through /P; /K is filled in once the kids exist
+    elem_ref = pdf.make_indirect(pikepdf.Dictionary({
+        '/Type': _NAME_STRUCTELEM,
+        '/S': struct_type,  # Structure type
+        '/T': title,     # Title (just the tag type)
+        '/P': parent
+    }))
     
-    # Create kids array with MCID reference
-    kids_array = pikepdf.Array([mcid_dict])
+    # Kids: MCID reference (+ description child), turned into an Array once below
+    kids = []
+    
+    if mcid is not None:
+        # Create MCID dictionary that links to content
+        kids.append(pikepdf.Dictionary({
+            '/Type': _NAME_MCR,  # Marked Content Reference
+            '/MCID': mcid,
+            '/Pg': page_obj  # Link to page object (looked up once per page by the caller)
+        }))
     
     # If we have content, add a child element with description
     if content and len(content) > 0:
-        # Get description from content (first 100 chars)
-        words = content.replace('\n', ' ').replace('\t', ' ').split()
-        if len(words) > 0:
-            desc_words = words[:10]
-            description = ' '.join(desc_words)[:100]
-            
-            # Create a child element for the description
-            desc_elem = pikepdf.Dictionary({
-                '/Type': pikepdf.Name.StructElem,
-                '/S': pikepdf.Name('/Span'),  # Span element for text
+        # Get description from content (first 100 chars, whitespace collapsed)
+        description = _WS_RE.sub(' ', content[:200]).strip()[:100]
+        if description:
+            # Create a child element for the description, fully populated before make_indirect
+            kids.append(pdf.make_indirect(pikepdf.Dictionary({
+                '/Type': _NAME_STRUCTELEM,
+                '/S': _NAME_SPAN,  # Span element for text
                 '/T': description,  # Description text
+                '/P': elem_ref,
                 '/K': pikepdf.Array([])
-            })
-            
-            desc_ref = pdf.make_indirect(desc_elem)
-            kids_array.append(desc_ref)
+            })))
     
-    # Create element with MCID reference and children
-    elem_data = {
-        '/Type': pikepdf.Name.StructElem,
-        '/S': tag_type,  # Structure type
-        '/T': title,     # Title (just the tag type)
-        '/P': None,      # Will be set
-        '/K': kids_array  # MCID reference + description child
-    }
-    
-    elem_ref = pdf.make_indirect(pikepdf.Dictionary(elem_data))
+    # A lone kid can be /K itself; only wrap in an Array when there are several
+    elem_ref['/K'] = kids[0] if len(kids) == 1 else pikepdf.Array(kids)
     return elem_ref
 
 
-def inject_mcids_for_page(page_obj, struct_elements, pdf):
-    """Inject MCID markers into a page's content stream"""
+def read_page_content(page_obj):
+    """
+    Return a page's content bytes, its content streams joined in order
+    
+    Nothing is written to the page; inject_mcids_for_pages coalesces the
+    streams only on pages it actually rewrites.
+    """
     
     try:
-        # For proper pink border highlighting, we need to inject MCID markers
-        # into the actual content stream. This is complex and requires:
-        # 1. Parsing PDF operators (TJ, Tj, q, Q, BT, ET, etc.)
-        # 2. Identifying text rendering positions
-        # 3. Inserting /BMC ... /EMC markers
-        
-        # Current implementation creates structure elements with MCID references
-        # For full content linkage, the content streams need to be modified
+        if '/Contents' not in page_obj:
+            return None
         
-        # NOTE: Full MCID injection into content streams requires deep PDF manipulation
-        # and is typically done by specialized libraries or manual tagging in Acrobat Pro
-        
-        logger.info(f"  ✓ Structure elements with MCID references created")
-        logger.info(f"  ℹ For full pink border highlighting, manually link content in Acrobat Pro")
+        contents = page_obj.Contents
+        if isinstance(contents, pikepdf.Array):
+            # Streams split only between tokens, so a newline keeps them apart
+            return b'\n'.join(stream.read_bytes() for stream in contents)
+        return contents.read_bytes()
         
     except Exception as e:
         logger.warning(f"Error accessing page content: {e}")
+        return None
+
+
+def inject_mcids_for_pages(page_markers):
+    """
+    Inject MCID markers into the content streams of several pages
+    
+    page_markers is a list of (page_obj, [tag_type, ...]) pairs. A page's
+    text blocks are wrapped in /Tag <</MCID n>> BDC ... EMC pairs in order,
+    MCID n going to the page's n-th tag. Tags are matched to text blocks by
+    position only, not by comparing their text.
+    
+    Returns the number of marked MCIDs (0..n-1) for each page, in order.
+    
+    pikepdf objects can't be pickled but content bytes can, so for larger
+    documents the rewriting runs in worker processes and only the results
+    are written back here.
+    """
+    
+    marked_counts = [0] * len(page_markers)
+    
+    jobs = []
+    for index, (page_obj, tag_types) in enumerate(page_markers):
+        if not tag_types:
+            continue
+        content_bytes = read_page_content(page_obj)
+        
+        # Pages with no text blocks at all (scans, pure graphics) need no lexing
+        if content_bytes is not None and b'BT' in content_bytes:
+            jobs.append((index, page_obj, content_bytes, tag_types))
+    
+    contents = [content_bytes for _, _, content_bytes, _ in jobs]
+    markers = [tag_types for _, _, _, tag_types in jobs]
+    results = None
+    
+    if len(jobs) >= _PARALLEL_MIN_PAGES:
+        try:
+            workers = os.cpu_count() or 1
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                chunksize = max(1, len(jobs) // (workers * 4))
+                results = list(executor.map(mark_text_blocks, contents, markers, chunksize=chunksize))
+        except Exception as e:
+            logger.warning(f"Parallel MCID injection failed, continuing serially: {e}")
+    
+    if results is None:
+        results = [mark_text_blocks(c, m) for c, m in zip(contents, markers)]
+    
+    for (index, page_obj, _, _), (marked, count) in zip(jobs, results):
+        if count:
+            # Only rewritten pages get their content streams merged into one
+            pikepdf.Page(page_obj).contents_coalesce()
+            page_obj.Contents.write(marked)
+            marked_counts[index] = count
+    
+    logger.debug("  ✓ Injected MCID markers into %d pages", sum(1 for count in marked_counts if count))
+    
+    return marked_counts
 
 
-def inject_mcid_markers(content_str: str, struct_elements: list) -> str:
+def find_text_blocks(content_bytes: bytes):
     """
-    Inject MCID markers into content stream
+    Yield (start, end) byte offsets of BT ... ET blocks that show text (Tj, TJ, ', ")
     
-    Strategy:
-    - Find text rendering operators (TJ, Tj)
-    - Insert /BMC before and /EMC after with MCID
-    - Group by structure element
+    Driven by the content stream lexer, so BT/ET inside strings, names,
+    comments or inline image data are not mistaken for operators. Blocks
+    that only set text state are skipped and get no MCID.
     """
     
-    # Simple approach: Inject at major text sections
-    # In production, would parse and identify exact positions
-    
-    lines = content_str.split('\n')
-    modified_lines = []
-    
-    current_mcid = 0
-    in_text_block = False
-    
-    for line in lines:
-        modified_lines.append(line)
-        
-        # Detect text rendering operators
-        if '/TJ' in line or '/Tj' in line:
-            if not in_text_block and current_mcid < len(struct_elements):
-                # Insert BMC marker
-                mcid, struct_elem = struct_elements[current_mcid]
-                bmc_marker = f"  /BMC /Artifact << /MCID {mcid} >> BDC"
-                # Find insertion point (before text operator)
-                modified_lines.insert(-1, bmc_marker)
-                in_text_block = True
-        
-        # Detect end of text block
-        if 'ET' in line and in_text_block:
-            # Insert EMC marker
-            emc_marker = "  /EMC EMC"
-            modified_lines.append(emc_marker)
-            in_text_block = False
-            current_mcid += 1
-    
-    return '\n'.join(modified_lines)
+    block_start = None
+    shows_text = False
+    
+    for op, start, end in iter_operators(content_bytes):
+        if op == b'BT':
+            block_start = start
+            shows_text = False
+        elif op in _TEXT_SHOW_OPS:
+            shows_text = True
+        elif op == b'ET' and block_start is not None:
+            if shows_text:
+                yield block_start, end
+            block_start = None
+
+
+def mark_text_blocks(content_bytes: bytes, tag_types: list):
+    """
+    Wrap text blocks in marked content, the n-th block getting MCID n and tag_types[n]
+    
+    Returns (content, marked): the rewritten bytes and the number of blocks
+    marked, or content_bytes unchanged and 0 when there is nothing to mark.
+    """
+    
+    if not tag_types:
+        return content_bytes, 0
+    
+    out = bytearray()
+    last = 0
+    marked = 0
+    
+    for mcid, (tag_type, (start, end)) in enumerate(zip(tag_types, find_text_blocks(content_bytes))):
+        out += content_bytes[last:start]
+        out += b'/%s <</MCID %d>> BDC\n' % (tag_type.encode('ascii'), mcid)
+        out += content_bytes[start:end]
+        out += b'\nEMC'
+        last = end
+        marked = mcid + 1
+    
+    if not marked:
+        return content_bytes, 0
+    
+    out += content_bytes[last:]
+    return bytes(out), marked
 
 
 if __name__ == "__main__":
@@ -4,32 +4,55 @@ Creates proper tagged PDF with structure tree
 """
 
 import pikepdf
-import json
 import logging
 from pathlib import Path
 from typing import Dict, List, Optional
 
+from pdf_structure_taxonomy import TagType
+from tags_json import load_tags_json
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Name objects reused for every structure element
+_NAME_STRUCT_TREE_ROOT = pikepdf.Name('/StructTreeRoot')
+_NAME_STRUCTELEM = pikepdf.Name('/StructElem')
+_TAG_TYPE_NAMES = {t.value: pikepdf.Name(f'/{t.value}') for t in TagType}
+
+
+def _tag_type_name(tag_type: str):
+    """Name object for a tag type, built once per distinct type and reused"""
+    struct_type = _TAG_TYPE_NAMES.get(tag_type)
+    if struct_type is None:
+        struct_type = _TAG_TYPE_NAMES[tag_type] = pikepdf.Name(f'/{tag_type}')
+    return struct_type
 
-def create_tagged_pdf_with_pikepdf(input_pdf: str, json_tags_file: str, output_pdf: str):
+
+def create_tagged_pdf_with_pikepdf(input_pdf: str, json_tags_file: str, output_pdf: str) -> str:
     """Create tagged PDF using pikepdf"""
     
+    # Load JSON tags
+    data = load_tags_json(json_tags_file)
+    
+    return build_tagged_pdf(input_pdf, data, output_pdf)
+
+
+def build_tagged_pdf(input_pdf: str, tags_data: Dict, output_pdf: str) -> str:
+    """Create tagged PDF from an in-memory structure tags document"""
+    
     logger.info("="*70)
     logger.info("Creating Tagged PDF with pikepdf")
     logger.info("No element limit - all tags will be processed!")
     logger.info("="*70)
     
-    # Load JSON tags
-    with open(json_tags_file, 'r') as f:
-        data = json.load(f)
-    
-    tags = data['document']['structure_tags']
+    tags = tags_data['document']['structure_tags']
     logger.info(f"Loaded {len(tags)} structure tags")
     
-    # Open PDF
-    pdf = pikepdf.open(input_pdf)
+    # Open PDF (memory-mapped so qpdf pages large inputs in lazily)
+    try:
+        pdf = pikepdf.open(input_pdf, access_mode=pikepdf.AccessMode.mmap)
+    except (OSError, ValueError):
+        pdf = pikepdf.open(input_pdf)
     
     try:
         logger.info("Creating structure tree...")
@@ -46,18 +69,18 @@ def create_tagged_pdf_with_pikepdf(input_pdf: str, json_tags_file: str, output_p
         
         # Process each root-level tag
         for idx, tag_data in enumerate(structured_tags):
-            logger.info(f"Processing root element {idx + 1}/{len(structured_tags)}: {tag_data.get('type', 'unknown')}")
+            logger.debug("Processing root element %d/%d: %s", idx + 1, len(structured_tags), tag_data.get('type', 'unknown'))
             
             # Create structure element with proper PDF references
             struct_elem = create_structure_element(tag_data, pdf, page)
             
             if struct_elem:
                 structure_elements.append(struct_elem)
-                logger.info(f"✓ Added {tag_data.get('type', 'unknown')}")
+                logger.debug("✓ Added %s", tag_data.get('type', 'unknown'))
         
         # Create structure tree root
         struct_tree_root = pikepdf.Dictionary({
-            '/Type': pikepdf.Name('/StructTreeRoot'),
+            '/Type': _NAME_STRUCT_TREE_ROOT,
             '/K': pikepdf.Array(structure_elements),
             '/ParentTree': pikepdf.Dictionary({'/Nums': pikepdf.Array([])})
         })
@@ -75,7 +98,14 @@ def create_tagged_pdf_with_pikepdf(input_pdf: str, json_tags_file: str, output_p
         
         # Save
         logger.info(f"Saving to: {output_pdf}")
-        pdf.save(output_pdf)
+        pdf.save(
+            output_pdf,
+            compress_streams=True,
+            object_stream_mode=pikepdf.ObjectStreamMode.generate,
+            stream_decode_level=pikepdf.StreamDecodeLevel.none,  # Copy existing streams through as-is
+            fix_metadata_version=False,  # Leave XMP metadata alone, no extra rewrite
+            linearize=False
+        )
         logger.info("✓ Saved")
         
         logger.info("\n" + "="*70)
@@ -89,16 +119,22 @@ def create_tagged_pdf_with_pikepdf(input_pdf: str, json_tags_file: str, output_p
         raise
     finally:
         pdf.close()
+    
+    return output_pdf
 
 
 def build_hierarchy(tags):
     """Build hierarchical structure from flat tags - group list items under L tags"""
     
+    # Nothing to group: the flat tag list is already the hierarchy
+    if not any(tag.get('type') == 'LI' for tag in tags):
+        return tags
+    
     structured = []
     i = 0
     
     while i < len(tags):
-        tag = tags[i].copy()
+        tag = tags[i]  # Read-only below, so no copy needed
         
         # If this is a list item
         if tag['type'] == 'LI':
@@ -126,17 +162,42 @@ def build_hierarchy(tags):
 
 
 def create_structure_element(tag_data: Dict, pdf, page):
-    """Create a structure element with proper PDF references"""
+    """Create a structure element (and its children) with proper PDF references"""
+    
+    # Post-order walk with an explicit stack: an element is built once all
+    # of its children are, so deep nesting never hits the recursion limit
+    built = {}  # id(tag dict) -> element, or None if it could not be created
+    stack = [(tag_data, False)]
+    
+    while stack:
+        node, children_done = stack.pop()
+        children = [child for child in node.get('children') or [] if isinstance(child, dict)]
+        
+        if children and not children_done:
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(children))
+            continue
+        
+        kids = [built[id(child)] for child in children]
+        built[id(node)] = _build_element(node, kids, pdf)
+    
+    return built[id(tag_data)]
+
+
+def _build_element(tag_data: Dict, kids: List, pdf):
+    """Create one structure element given its already-built children"""
     
     try:
         tag_type_str = tag_data.get('type', 'P').replace('/', '').upper()
         content = tag_data.get('content', '')
         
-        # Create dictionary for structure element
+        struct_type = _tag_type_name(tag_type_str)
+        
+        # Create dictionary for structure element (children turned into one Array)
         elem_dict = {
-            '/Type': pikepdf.Name('/StructElem'),
-            '/S': pikepdf.Name(f'/{tag_type_str}'),
-            '/K': pikepdf.Array([])
+            '/Type': _NAME_STRUCTELEM,
+            '/S': struct_type,
+            '/K': pikepdf.Array([kid for kid in kids if kid is not None])
         }
         
         # Add attributes
@@ -146,16 +207,6 @@ def create_structure_element(tag_data: Dict, pdf, page):
                 '/ActualText': attrs['actualText']
             })
         
-        # Process children if any
-        if 'children' in tag_data and tag_data['children']:
-            kids_array = pikepdf.Array([])
-            for child_data in tag_data['children']:
-                if isinstance(child_data, dict):
-                    child_elem = create_structure_element(child_data, pdf, page)
-                    if child_elem:
-                        kids_array.append(child_elem)
-            elem_dict['/K'] = kids_array
-        
         # Create PDF object
         elem_obj = pdf.make_indirect(pikepdf.Dictionary(elem_dict))
         return elem_obj
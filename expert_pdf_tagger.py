@@ -4,23 +4,32 @@ Implements comprehensive structure tag classification and intelligent caching
 """
 
 import os
-import json
+import re
+import atexit
+import time
+import sqlite3
 import hashlib
 import logging
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
 from typing import Dict, List, Tuple, Optional, Any
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, asdict, is_dataclass
 from datetime import datetime
 from pathlib import Path
 
-import pymupdf  # PyMuPDF (fitz)
-import pdfplumber
-import google.generativeai as genai
 from dotenv import load_dotenv
 
+# pymupdf and google.generativeai are imported where they are used, so
+# importing this module (e.g. for its dataclasses or cache) stays cheap
+
 # Import our taxonomy
 from pdf_structure_taxonomy import (
-    StructureTag, StructureAttributes, TagType, TaxonomyClassifier
+    StructureTag, StructureAttributes, TagType, TaxonomyClassifier, TAG_TYPE_BY_VALUE,
+    _ATTRIBUTE_FIELDS
 )
+from tags_json import json_dumps, json_loads
 
 # Load environment variables
 try:
@@ -36,6 +45,136 @@ logger = logging.getLogger(__name__)
 CACHE_DIR = Path("accessibility_cache")
 CACHE_DIR.mkdir(exist_ok=True)
 
+# Below this many pages, worker start-up costs more than parallel extraction saves
+_PARALLEL_MIN_PAGES = 8
+
+# Patterns used per element, compiled once
+# Numbered heading ("1. Intro") or ASCII all-caps line, in one match
+_HEADING_RE = re.compile(r'^(?:\d+[\.\)]\s+[A-Z]|[A-Z][A-Z\s]{5,}$)')
+
+# List item markers
+_BULLETS = ('•', '▪', '▫', '‣', '⁃', '◦', '○', '●')
+_BULLET_SET = frozenset(_BULLETS)
+_BULLET_SEP = '\x1f'
+_BULLET_TRANS = str.maketrans({bullet: _BULLET_SEP for bullet in _BULLETS})
+_LIST_NUM_RE = re.compile(r'^\d+[\.\)]\s+')
+_LIST_LETTERS = frozenset('abcdefghijklmnopqrstuvwxyz')
+_ROMAN_LETTERS = frozenset('ivxlcdmIVXLCDM')
+_LIST_ALPHA_RE = re.compile(r'^[a-z][\.\)]\s+')
+_LIST_ROMAN_RE = re.compile(r'^[ivxlcdm]+[\.\)]\s+', re.IGNORECASE)
+_LIST_SPLIT_RE = re.compile(r'\n\s*\d+[\.\)]\s+')
+
+# Static instructions shared by every attribute request. Sent once as the
+# model's system instruction so the API can cache the prefix across calls.
+_TAG_TYPES_DESCRIPTION = "\n".join(f"- {tag}" for tag in sorted(t.value for t in TagType))
+_SYSTEM_PROMPT = f"""You are a PDF accessibility expert specializing in WCAG 2.1 AA and PDF/UA compliance.
+
+You classify PDF content elements using the comprehensive PDF/UA structure taxonomy
+and generate their accessibility attributes.
+
+AVAILABLE PDF/UA TAG TYPES:
+{_TAG_TYPES_DESCRIPTION}
+
+CLASSIFICATION INSTRUCTIONS:
+1. For TAG TYPE "Title": Use when content is a document title, section title, or standalone title element
+2. For TAG TYPES "H1-H6": Use for headings with appropriate hierarchy level
+3. For TAG TYPE "H": Generic heading without specific level
+4. For TAG TYPE "P": Use for paragraphs and body text
+5. For TAG TYPE "Figure": Use for images, charts, diagrams with captions
+6. For TAG TYPE "Caption": Use for descriptive text below figures/tables
+7. For TAG TYPE "Formula": Use for mathematical equations
+8. For TAG TYPE "Table": Use for tabular data structures
+9. For TAG TYPE "L" and "LI": Use for lists and list items
+10. For TAG TYPE "Quote": Use for quoted text
+11. For TAG TYPE "Note": Use for notes, callouts, annotations
+12. For TAG TYPE "Link": Use for hyperlinks
+13. For TAG TYPE "TOC": Use for table of contents
+14. For TAG TYPE "TOCI": Use for table of contents items
+
+ACCESSIBILITY ATTRIBUTES (one JSON object per element):
+- "actualText": "Full text as it appears for screen readers" (REQUIRED)
+- "lang": "Language code (default: en)" (REQUIRED)
+- "title": "Short descriptive title of the element"
+- "summary": "Detailed summary explaining the purpose and meaning of this content"
+- "alt": "Alternative text description (for figures, tables, formulas)"
+
+IMPORTANT:
+- Title elements: Use descriptive, concise titles that identify the purpose
+- Headings: Preserve the heading level from DETECTED TYPE if specified (h1, h2, etc.)
+- Tables: Provide detailed alt text describing the table structure
+- Figures: Provide descriptive alt text of visual content
+- Ensure all text is accessible and meaningful for screen readers
+"""
+
+# Tag types whose attributes need the LLM (alt text, titles, summaries).
+# Everything else gets actualText = content and lang = en without a request.
+_LLM_REQUIRED_TAGS = frozenset((
+    TagType.FIGURE, TagType.FORMULA, TagType.TABLE,
+    TagType.TITLE, TagType.LINK, TagType.FORM, TagType.ANNOT,
+))
+
+# Tag type lookups, built once instead of formatting/constructing per element
+_S_NAMES = {t: f'/{t.value}' for t in TagType}
+
+
+@lru_cache(maxsize=4096)
+def _classify(content: str, context: str, detected_type: str) -> TagType:
+    """TaxonomyClassifier.classify_content, memoized across cache key and tag generation"""
+    return TaxonomyClassifier.classify_content(content, context, detected_type)
+
+
+def _parse_llm_json(text: str, opening: str, closing: str) -> Any:
+    """Parse an LLM's JSON answer, cutting it out of surrounding text if needed"""
+    try:
+        return json_loads(text)
+    except ValueError:
+        # Wrapped in prose or a code fence: keep the outermost opening..closing span
+        start = text.find(opening)
+        end = text.rfind(closing)
+        if start < 0 or end < start:
+            raise
+        return json_loads(text[start:end + 1])
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """Retry delay in seconds a rate-limit error carries, or None"""
+    
+    # ResourceExhausted: retry_delay on the error or on its RetryInfo detail
+    delay = getattr(error, "retry_delay", None)
+    if delay is None:
+        for detail in getattr(error, "details", None) or ():
+            delay = getattr(detail, "retry_delay", None)
+            if delay is not None:
+                break
+    
+    # HTTP transports: the Retry-After header
+    if delay is None:
+        headers = getattr(getattr(error, "response", None), "headers", None)
+        if headers:
+            delay = headers.get("Retry-After")
+    
+    if delay is None:
+        return None
+    if hasattr(delay, "total_seconds"):  # timedelta
+        return delay.total_seconds()
+    if hasattr(delay, "seconds"):  # protobuf Duration
+        return delay.seconds + getattr(delay, "nanos", 0) / 1e9
+    try:
+        return float(delay)
+    except (TypeError, ValueError):
+        return None  # e.g. an HTTP date
+
+
+def _json_default(obj: Any) -> Any:
+    """JSON fallback for values the encoder can't handle itself"""
+    if isinstance(obj, TagType):
+        return obj.value
+    if is_dataclass(obj):
+        return asdict(obj)
+    if hasattr(obj, '__dict__'):
+        return vars(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
 
 @dataclass
 class ExtractedElement:
@@ -70,23 +209,52 @@ class ClassifiedElement:
 class ExpertTagGenerator:
     """Generate expert-level PDF accessibility tags with LLM"""
     
-    def __init__(self, api_key: str, model: str = "gemini-2.5-flash"):
+    # Elements sent to the LLM in one batched prompt
+    BATCH_SIZE = 8
+    
+    # Batched prompts in flight at once (the calls are network-bound)
+    MAX_WORKERS = 16
+    
+    # Request rate kept under the API quota, shared by all worker threads
+    # (GEMINI_RPM overrides it per instance)
+    REQUESTS_PER_MINUTE = 60
+    
+    # Retries after a rate-limit (429) response, with exponential backoff
+    MAX_RETRIES = 5
+    
+    def __init__(self, api_key: str, model: str = "gemini-2.5-flash", llm_all: bool = False):
+        import google.generativeai as genai
+        
         genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel(model)
+        self.model = genai.GenerativeModel(model, system_instruction=_SYSTEM_PROMPT)
         self.model_name = model
         
-    def generate_structure_tags(self, element: ExtractedElement) -> ClassifiedElement:
-        """Generate complete PDF/UA structure tags for an element"""
+        # llm_all: ask the LLM for every element, not only _LLM_REQUIRED_TAGS
+        self.llm_all = llm_all
+        
+        # A bad GEMINI_RPM value falls back to the default instead of failing
+        try:
+            self.requests_per_minute = int(os.getenv("GEMINI_RPM", self.REQUESTS_PER_MINUTE))
+        except ValueError:
+            logger.warning(f"Invalid GEMINI_RPM value, using {self.REQUESTS_PER_MINUTE}")
+            self.requests_per_minute = self.REQUESTS_PER_MINUTE
+        
+        # RPM gate: each request reserves the next free start slot
+        self._rate_lock = threading.Lock()
+        self._next_request = time.monotonic()
+        
+    def generate_structure_tags(self, element: ExtractedElement,
+                                tag_type: Optional[TagType] = None) -> ClassifiedElement:
+        """Generate complete PDF/UA structure tags for an element (tag_type if already classified)"""
         
         # First, classify the tag type
-        tag_type = TaxonomyClassifier.classify_content(
-            element.content,
-            element.metadata.get("context", "") if element.metadata else "",
-            element.detected_type
-        )
+        if tag_type is None:
+            tag_type = self.classify(element)
         
-        # Generate detailed attributes with LLM
-        attributes = self._generate_attributes(element, tag_type)
+        # Generate detailed attributes with LLM (defaults suffice for plain text)
+        attributes = self._generate_attributes(element, tag_type) if self.needs_llm(tag_type) else None
+        if attributes is None:
+            attributes = self._default_attributes(element, tag_type)
         
         # Create classified element
         classified = ClassifiedElement(
@@ -99,100 +267,260 @@ class ExpertTagGenerator:
         
         return classified
     
-    def _generate_attributes(self, element: ExtractedElement, tag_type: TagType) -> StructureAttributes:
-        """Generate PDF/UA attributes using LLM"""
+    def default_structure_tags(self, element: ExtractedElement, tag_type: TagType) -> ClassifiedElement:
+        """Structure tags with default attributes, no LLM call"""
+        return ClassifiedElement(
+            tag_type=tag_type,
+            content=element.content,
+            attributes=self._default_attributes(element, tag_type),
+            page=element.page,
+            children=None
+        )
+    
+    def classify(self, element: ExtractedElement) -> TagType:
+        """Taxonomy tag type for an element"""
+        return _classify(
+            element.content,
+            element.metadata.get("context", "") if element.metadata else "",
+            element.detected_type
+        )
+    
+    def needs_llm(self, tag_type: TagType) -> bool:
+        """Whether attributes for this tag type come from the LLM"""
+        return self.llm_all or tag_type in _LLM_REQUIRED_TAGS
+    
+    def generate_structure_tags_batch(self, elements: List[ExtractedElement],
+                                      tag_types: Optional[List[TagType]] = None) -> List[Optional[ClassifiedElement]]:
+        """
+        Generate structure tags for many elements, one LLM call per BATCH_SIZE elements
+        
+        Elements the LLM gave no result for come back as None, so callers can
+        tell a real result from a fallback (default_structure_tags builds one).
+        """
+        
+        if tag_types is None:
+            tag_types = [self.classify(element) for element in elements]
+        
+        # Plain-text elements get default attributes; only the rest are sent
+        classified = [None] * len(elements)
+        llm_indices = []
+        for i, (element, tag_type) in enumerate(zip(elements, tag_types)):
+            if self.needs_llm(tag_type):
+                llm_indices.append(i)
+            else:
+                classified[i] = self.default_structure_tags(element, tag_type)
+        
+        if not llm_indices:
+            return classified
+        
+        llm_elements = [elements[i] for i in llm_indices]
+        llm_types = [tag_types[i] for i in llm_indices]
+        
+        starts = range(0, len(llm_elements), self.BATCH_SIZE)
+        chunks = [llm_elements[start:start + self.BATCH_SIZE] for start in starts]
+        chunk_types = [llm_types[start:start + self.BATCH_SIZE] for start in starts]
+        
+        # Send the chunks concurrently; map() keeps results in chunk order
+        if len(chunks) > 1:
+            with ThreadPoolExecutor(max_workers=min(self.MAX_WORKERS, len(chunks))) as executor:
+                results = list(executor.map(self._generate_chunk, chunks, chunk_types))
+        else:
+            results = [self._generate_chunk(chunk, types) for chunk, types in zip(chunks, chunk_types)]
+        
+        generated = [item for chunk_result in results for item in chunk_result]
+        for i, item in zip(llm_indices, generated):
+            classified[i] = item
+        
+        return classified
+    
+    def _generate_chunk(self, chunk: List[ExtractedElement],
+                        tag_types: List[TagType]) -> List[Optional[ClassifiedElement]]:
+        """Generate attributes for one chunk of classified elements in one call (None where it failed)"""
+        
+        attributes = self._generate_attributes_batch(chunk, tag_types)
+        
+        return [
+            ClassifiedElement(
+                tag_type=tag_type,
+                content=element.content,
+                attributes=attrs,
+                page=element.page,
+                children=None
+            ) if attrs is not None else None
+            for element, tag_type, attrs in zip(chunk, tag_types, attributes)
+        ]
+    
+    def _generate_attributes_batch(self, elements: List[ExtractedElement],
+                                   tag_types: List[TagType]) -> List[Optional[StructureAttributes]]:
+        """Generate PDF/UA attributes for several elements with a single LLM call (None where it failed)"""
+        
+        if len(elements) == 1:
+            return [self._generate_attributes(elements[0], tag_types[0])]
+        
+        prompt = self._create_batch_prompt(elements, tag_types)
+        
+        try:
+            response = self._call_model(
+                prompt,
+                generation_config={
+                    "temperature": 0.3,
+                    "max_output_tokens": 1024 * len(elements),
+                    "response_mime_type": "application/json",
+                }
+            )
+            
+            if not response.text:
+                raise ValueError("Empty LLM response")
+            
+            # Extract the JSON array
+            results = _parse_llm_json(response.text, '[', ']')
+            
+            if not isinstance(results, list):
+                raise ValueError(f"Expected a JSON array, got {type(results).__name__}")
+            
+            # Match results back by idx; objects without one keep their position
+            by_idx = {}
+            for position, result in enumerate(results):
+                if isinstance(result, dict):
+                    try:
+                        by_idx[int(result.get("idx", position))] = result
+                    except (TypeError, ValueError):
+                        continue
+            
+            missing = len(elements) - sum(1 for i in range(len(elements)) if i in by_idx)
+            if missing:
+                logger.debug("Batched response missing %d of %d elements", missing, len(elements))
+            
+            return [
+                self._attributes_from_result(by_idx[i], element) if i in by_idx else None
+                for i, element in enumerate(elements)
+            ]
+            
+        except Exception as e:
+            # Fall back to one call per element so a bad batch costs no tags
+            logger.warning(f"Batched attribute generation failed ({e}), retrying per element")
+            return [
+                self._generate_attributes(element, tag_type)
+                for element, tag_type in zip(elements, tag_types)
+            ]
+    
+    def _call_model(self, prompt: str, generation_config: Dict):
+        """generate_content, paced to requests_per_minute and retried on rate limits"""
+        
+        interval = 60.0 / max(self.requests_per_minute, 1)
+        delay = 2.0
+        
+        for attempt in range(self.MAX_RETRIES + 1):
+            with self._rate_lock:
+                now = time.monotonic()
+                start = max(now, self._next_request)
+                self._next_request = start + interval
+            if start > now:
+                time.sleep(start - now)
+            
+            try:
+                return self.model.generate_content(prompt, generation_config=generation_config)
+            except Exception as e:
+                # ResourceExhausted is how the SDK reports HTTP 429
+                rate_limited = type(e).__name__ == "ResourceExhausted" or "429" in str(e)
+                if not rate_limited or attempt == self.MAX_RETRIES:
+                    raise
+                
+                # Wait at least as long as the server asks (Retry-After / retry_delay)
+                wait = max(delay, _retry_after(e) or 0.0)
+                logger.warning(f"Rate limited, retrying in {wait:.0f}s ({attempt + 1}/{self.MAX_RETRIES})")
+                
+                # Push the shared start slot back so every worker backs off, not only
+                # this one; the next loop iteration then sleeps until it comes round
+                with self._rate_lock:
+                    self._next_request = max(self._next_request, time.monotonic() + wait)
+                delay *= 2
+    
+    def _generate_attributes(self, element: ExtractedElement, tag_type: TagType) -> Optional[StructureAttributes]:
+        """Generate PDF/UA attributes using LLM (None when the call fails)"""
         
         # Use LLM to generate descriptive attributes
         prompt = self._create_classification_prompt(element, tag_type)
         
         try:
-            response = self.model.generate_content(
+            response = self._call_model(
                 prompt,
                 generation_config={
                     "temperature": 0.3,
                     "max_output_tokens": 1024,
+                    "response_mime_type": "application/json",
                 }
             )
             
             if not response.text:
-                logger.warning("Empty LLM response, using defaults")
-                return self._default_attributes(element, tag_type)
+                logger.warning("Empty LLM response")
+                return None
             
-            # Parse LLM response
-            result_text = response.text.strip()
-            
-            # Try to extract JSON
-            import re
-            json_match = re.search(r'\{.*\}', result_text, re.DOTALL)
-            if json_match:
-                result = json.loads(json_match.group(0))
-            else:
-                # Try direct parsing
-                result = json.loads(result_text)
+            # Parse LLM response (JSON mode, so normally no extraction is needed)
+            result = _parse_llm_json(response.text, '{', '}')
             
             # Build attributes from LLM response
-            return StructureAttributes(
-                alt=result.get("alt"),
-                lang=result.get("lang", "en"),
-                actualText=result.get("actualText") or element.content,
-                title=result.get("title"),
-                summary=result.get("summary")
-            )
+            return self._attributes_from_result(result, element)
             
         except Exception as e:
             logger.warning(f"Error generating attributes: {e}")
-            return self._default_attributes(element, tag_type)
+            return None
+    
+    def _attributes_from_result(self, result: Dict, element: ExtractedElement) -> StructureAttributes:
+        """Build attributes from one parsed LLM result object"""
+        return StructureAttributes(
+            alt=result.get("alt"),
+            lang=result.get("lang", "en"),
+            actualText=result.get("actualText") or element.content,
+            title=result.get("title"),
+            summary=result.get("summary")
+        )
     
     def _create_classification_prompt(self, element: ExtractedElement, tag_type: TagType) -> str:
-        """Create prompt for LLM classification with full PDF/UA taxonomy"""
-        
-        # Get all available tag types from taxonomy
-        all_tag_types = [tag.value for tag in TagType]
-        tag_types_description = "\n".join([f"- {tag}" for tag in sorted(all_tag_types)])
+        """Create prompt for LLM classification (the static part is the system instruction)"""
         
-        prompt = f"""You are a PDF accessibility expert specializing in WCAG 2.1 AA and PDF/UA compliance.
-
-Analyze the PDF content and classify it using the comprehensive PDF/UA structure taxonomy.
-
-AVAILABLE PDF/UA TAG TYPES:
-{tag_types_description}
+        prompt = f"""Analyze the PDF content and classify it using the PDF/UA structure taxonomy.
 
 CURRENT TAG TYPE: {tag_type.value}
 CONTENT: {element.content[:500]}
 
 DETECTED TYPE: {element.detected_type}
 
-CLASSIFICATION INSTRUCTIONS:
-1. For TAG TYPE "Title": Use when content is a document title, section title, or standalone title element
-2. For TAG TYPES "H1-H6": Use for headings with appropriate hierarchy level
-3. For TAG TYPE "H": Generic heading without specific level
-4. For TAG TYPE "P": Use for paragraphs and body text
-5. For TAG TYPE "Figure": Use for images, charts, diagrams with captions
-6. For TAG TYPE "Caption": Use for descriptive text below figures/tables
-7. For TAG TYPE "Formula": Use for mathematical equations
-8. For TAG TYPE "Table": Use for tabular data structures
-9. For TAG TYPE "L" and "LI": Use for lists and list items
-10. For TAG TYPE "Quote": Use for quoted text
-11. For TAG TYPE "Note": Use for notes, callouts, annotations
-12. For TAG TYPE "Link": Use for hyperlinks
-13. For TAG TYPE "TOC": Use for table of contents
-14. For TAG TYPE "TOCI": Use for table of contents items
+Generate a JSON object with the accessibility attributes described in your instructions.
 
-Generate a JSON object with these accessibility attributes:
-- "actualText": "Full text as it appears for screen readers" (REQUIRED)
-- "lang": "Language code (default: en)" (REQUIRED)
-- "title": "Short descriptive title of the element"
-- "summary": "Detailed summary explaining the purpose and meaning of this content"
-- "alt": "Alternative text description (for figures, tables, formulas)"
+Return ONLY valid JSON, no explanations, no markdown code blocks, just the JSON object:
+"""
+        return prompt
+    
+    def _create_batch_prompt(self, elements: List[ExtractedElement], tag_types: List[TagType]) -> str:
+        """Create one prompt covering several elements, answered with a JSON array"""
+        
+        element_list = json_dumps([
+            {
+                "idx": i,
+                "tag_type": tag_type.value,
+                "detected_type": element.detected_type,
+                "content": element.content[:500]
+            }
+            for i, (element, tag_type) in enumerate(zip(elements, tag_types))
+        ], indent=True).decode('utf-8')
+        
+        prompt = f"""Analyze each PDF content element below using the PDF/UA structure taxonomy.
 
-IMPORTANT:
-- Title elements: Use descriptive, concise titles that identify the purpose
-- Headings: Preserve the heading level from DETECTED_TYPE if specified (h1, h2, etc.)
-- Tables: Provide detailed alt text describing the table structure
-- Figures: Provide descriptive alt text of visual content
-- Ensure all text is accessible and meaningful for screen readers
+ELEMENTS:
+{element_list}
 
-Return ONLY valid JSON, no explanations, no markdown code blocks, just the JSON object:
+For EACH element, generate a JSON object with its "idx" and the accessibility attributes
+described in your instructions.
+
+EXAMPLE:
+Elements: [{{"idx": 0, "tag_type": "H1", "detected_type": "h1", "content": "Annual Report 2023"}},
+           {{"idx": 1, "tag_type": "P", "detected_type": "paragraph", "content": "Revenue grew 12% year over year."}}]
+Answer: [{{"idx": 0, "actualText": "Annual Report 2023", "lang": "en", "title": "Annual Report 2023", "summary": "Document title heading"}},
+         {{"idx": 1, "actualText": "Revenue grew 12% year over year.", "lang": "en", "title": "Revenue growth", "summary": "States the annual revenue growth"}}]
+
+Return ONLY a JSON array with one object per element, each carrying its "idx",
+no explanations, no markdown code blocks, just the JSON array:
 """
         return prompt
     
@@ -207,297 +535,483 @@ Return ONLY valid JSON, no explanations, no markdown code blocks, just the JSON
 class IntelligentCache:
     """Advanced caching with similarity detection"""
     
+    # Inserts grouped into one SQLite transaction before set() commits
+    FLUSH_EVERY = 100
+    
+    # Part of every document key: bump when extraction, classification or the
+    # cached element layout changes, so stale whole-document results are ignored
+    DOCUMENT_VERSION = 1
+    
     def __init__(self, cache_dir: Path = CACHE_DIR):
         self.cache_dir = cache_dir
         self.cache_dir.mkdir(exist_ok=True)
-        self.cache_index_file = cache_dir / "cache_index.json"
-        self.index = self._load_index()
+        self.db_path = cache_dir / "cache.db"
+        
+        # One database instead of a JSON file per entry plus an index file.
+        # The cache is only used from the thread that created it, but the
+        # atexit close may run elsewhere, hence check_same_thread=False.
+        self.conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, payload BLOB NOT NULL, tag_type TEXT, created TEXT)"
+        )
+        # Whole-document results, keyed by file fingerprint + model
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "key TEXT PRIMARY KEY, payload BLOB NOT NULL, element_count INTEGER, created TEXT)"
+        )
+        self.conn.commit()
+        self._dirty = 0
         
-    def _load_index(self) -> Dict:
-        """Load cache index"""
-        if self.cache_index_file.exists():
-            with open(self.cache_index_file, 'r') as f:
-                return json.load(f)
-        return {}
+        # Make sure pending inserts reach disk even if close() is never called
+        # (close() unregisters this again, so the instance isn't kept alive)
+        atexit.register(self.close)
     
-    def _save_index(self):
-        """Save cache index"""
-        with open(self.cache_index_file, 'w') as f:
-            json.dump(self.index, f, indent=2)
+    def __enter__(self):
+        return self
     
-    def get_cache_key(self, content: str, tag_type: TagType, page: int = None) -> str:
-        """Generate cache key from content and type"""
-        # Create a normalized key
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def flush(self):
+        """Commit entries added since the last commit"""
+        if self._dirty:
+            self.conn.commit()
+            self._dirty = 0
+    
+    def close(self):
+        """Commit pending entries and close the database (safe to call twice)"""
+        if self.conn is None:
+            return
+        atexit.unregister(self.close)
+        self.flush()
+        self.conn.close()
+        self.conn = None
+    
+    def _key_data(self, content: str, tag_type: TagType, page: int = None) -> bytes:
+        """Normalized bytes that identify an element for caching"""
         normalized_content = content.lower().strip()[:200]  # First 200 chars
         key_data = f"{normalized_content}::{tag_type.value}"
         if page:
             key_data += f"::page{page}"
-        return hashlib.sha256(key_data.encode()).hexdigest()
+        return key_data.encode()
+    
+    def get_cache_key(self, content: str, tag_type: TagType, page: int = None) -> str:
+        """Generate cache key from content and type"""
+        # Non-cryptographic use: blake2b with a 128-bit digest is plenty and cheaper than sha256
+        return hashlib.blake2b(self._key_data(content, tag_type, page), digest_size=16).hexdigest()
+    
+    def get_legacy_cache_key(self, content: str, tag_type: TagType, page: int = None) -> str:
+        """Cache key as computed before keys moved to blake2b (sha256)"""
+        return hashlib.sha256(self._key_data(content, tag_type, page)).hexdigest()
+    
+    def get_document_key(self, pdf_path: str, model: str) -> str:
+        """Fingerprint a PDF file's bytes together with the model that tags it and DOCUMENT_VERSION"""
+        digest = hashlib.blake2b(digest_size=16)
+        with open(pdf_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        digest.update(f"::{model}::v{self.DOCUMENT_VERSION}".encode())
+        return digest.hexdigest()
+    
+    def get_document(self, doc_key: str) -> Optional[List[Dict]]:
+        """Get all classified elements of a previously tagged document"""
+        row = self.conn.execute(
+            "SELECT payload FROM documents WHERE key = ?", (doc_key,)
+        ).fetchone()
+        return json_loads(row[0]) if row is not None else None
+    
+    def set_document(self, doc_key: str, elements: List[Dict]):
+        """Save all classified elements of a document (committed immediately)"""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO documents (key, payload, element_count, created) VALUES (?, ?, ?, ?)",
+            (doc_key, json_dumps(elements, default=_json_default), len(elements), datetime.now().isoformat())
+        )
+        self.conn.commit()
+        self._dirty = 0
     
     def get(self, cache_key: str) -> Optional[Dict]:
         """Get from cache"""
-        if cache_key in self.index:
-            cache_file = self.cache_dir / f"{cache_key}.json"
-            if cache_file.exists():
-                logger.info(f"Cache hit: {cache_key[:16]}...")
-                with open(cache_file, 'r') as f:
-                    return json.load(f)
+        row = self.conn.execute(
+            "SELECT payload FROM cache WHERE key = ?", (cache_key,)
+        ).fetchone()
+        if row is not None:
+            logger.debug("Cache hit: %s...", cache_key[:16])
+            return json_loads(row[0])
+        
         return None
     
+    def get_legacy(self, cache_key: str, legacy_key: str) -> Optional[Dict]:
+        """
+        Look up an entry stored under its old sha256 key
+        
+        Covers database rows written before the switch to blake2b keys and the
+        old one-file-per-key cache; a hit is re-stored under cache_key.
+        """
+        row = self.conn.execute(
+            "SELECT payload FROM cache WHERE key = ?", (legacy_key,)
+        ).fetchone()
+        if row is not None:
+            data = json_loads(row[0])
+        else:
+            legacy_file = self.cache_dir / f"{legacy_key}.json"
+            if not legacy_file.exists():
+                return None
+            data = json_loads(legacy_file.read_bytes())
+        
+        logger.debug("Migrating cache entry: %s...", legacy_key[:16])
+        self.set(cache_key, data)
+        return data
+    
     def set(self, cache_key: str, data: Any):
         """Save to cache"""
-        cache_file = self.cache_dir / f"{cache_key}.json"
+        tag_type = data.get("tag_type", "unknown")
+        if isinstance(tag_type, TagType):
+            tag_type = tag_type.value
         
-        # Convert to JSON-serializable format
-        serializable_data = self._make_serializable(data)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO cache (key, payload, tag_type, created) VALUES (?, ?, ?, ?)",
+            (
+                cache_key,
+                json_dumps(data, default=_json_default),
+                tag_type,
+                datetime.now().isoformat()
+            )
+        )
         
-        with open(cache_file, 'w') as f:
-            json.dump(serializable_data, f, indent=2)
+        # Commit in batches rather than once per entry
+        self._dirty += 1
+        if self._dirty >= self.FLUSH_EVERY:
+            self.flush()
         
-        self.index[cache_key] = {
-            "created": datetime.now().isoformat(),
-            "tag_type": serializable_data.get("tag_type", "unknown")
-        }
-        self._save_index()
-        
-        logger.info(f"Cached: {cache_key[:16]}...")
-    
-    def _make_serializable(self, obj: Any) -> Any:
-        """Convert object to JSON-serializable format"""
-        if isinstance(obj, TagType):
-            return obj.value
-        elif isinstance(obj, dict):
-            return {k: self._make_serializable(v) for k, v in obj.items()}
-        elif isinstance(obj, list):
-            return [self._make_serializable(item) for item in obj]
-        elif hasattr(obj, '__dict__'):
-            # Handle dataclass
-            result = {}
-            for key, value in obj.__dict__.items():
-                result[key] = self._make_serializable(value)
-            return result
-        else:
-            return obj
+        logger.debug("Cached: %s...", cache_key[:16])
 
 
 class ExpertPDFTagger:
     """Expert PDF tagger with complete PDF/UA structure taxonomy"""
     
-    def __init__(self, api_key: str, model: str = "gemini-2.5-flash"):
-        self.tag_generator = ExpertTagGenerator(api_key, model)
+    def __init__(self, api_key: str, model: str = "gemini-2.5-flash", llm_all: bool = False):
+        self.tag_generator = ExpertTagGenerator(api_key, model, llm_all)
         self.cache = IntelligentCache()
         
     def extract_and_classify(self, pdf_path: str) -> List[ClassifiedElement]:
         """Extract elements and classify into PDF/UA taxonomy"""
         logger.info(f"Extracting and classifying: {pdf_path}")
         
+        # Same file, same model: reuse the whole result and skip extraction
+        # (--llm-all results are a different document result)
+        model_name = self.tag_generator.model_name
+        if self.tag_generator.llm_all:
+            model_name += ":llm-all"
+        doc_key = self.cache.get_document_key(pdf_path, model_name)
+        cached_doc = self.cache.get_document(doc_key)
+        if cached_doc is not None:
+            logger.info(f"Document cache hit: reusing {len(cached_doc)} classified elements")
+            return [self._classified_from_cache(cached) for cached in cached_doc]
+        
         elements = self._extract_elements(pdf_path)
-        classified_elements = []
+        classified_elements = [None] * len(elements)
+        
+        # Cache misses as (index, element, tag_type, cache_key), generated in batches below;
+        # only tag types that need the LLM get here
+        misses = []
+        fallbacks = 0
         
         for i, element in enumerate(elements):
-            logger.info(f"Processing element {i+1}/{len(elements)}: {element.detected_type}")
+            logger.debug("Processing element %d/%d: %s", i + 1, len(elements), element.detected_type)
+            
+            # Classify once: the same tag type keys the cache and drives generation
+            tag_type = self.tag_generator.classify(element)
+            
+            # Defaults are never cached (cheaper to rebuild than to look up)
+            if not self.tag_generator.needs_llm(tag_type):
+                classified_elements[i] = self.tag_generator.default_structure_tags(element, tag_type)
+                continue
             
             # Check cache first
-            cache_key = self.cache.get_cache_key(
-                element.content,
-                TaxonomyClassifier.classify_content(element.content, "", element.detected_type)
-            )
+            cache_key = self.cache.get_cache_key(element.content, tag_type)
             
             cached = self.cache.get(cache_key)
+            if cached is None:
+                # Only misses pay for the legacy key
+                cached = self.cache.get_legacy(
+                    cache_key, self.cache.get_legacy_cache_key(element.content, tag_type)
+                )
             if cached:
-                # Convert tag_type string back to TagType enum
-                if isinstance(cached.get('tag_type'), str):
-                    cached['tag_type'] = TagType(cached['tag_type'])
-                classified = ClassifiedElement(**cached)
-                classified_elements.append(classified)
+                classified_elements[i] = self._classified_from_cache(cached)
                 continue
             
-            # Generate tags with LLM
-            classified = self.tag_generator.generate_structure_tags(element)
+            misses.append((i, element, tag_type, cache_key))
+        
+        if misses:
+            logger.info(f"Generating tags for {len(misses)} uncached elements")
             
-            # Cache the result
-            self.cache.set(cache_key, asdict(classified))
+            # Generate tags with LLM, several elements per request
+            generated = self.tag_generator.generate_structure_tags_batch(
+                [element for _, element, _, _ in misses],
+                [tag_type for _, _, tag_type, _ in misses]
+            )
+            
+            for (i, element, tag_type, cache_key), classified in zip(misses, generated):
+                if classified is None:
+                    # The LLM gave no result: use defaults, but don't cache them as one
+                    classified = self.tag_generator.default_structure_tags(element, tag_type)
+                    fallbacks += 1
+                else:
+                    # Cache LLM results (here, on the calling thread, so the cache needs no locking)
+                    self.cache.set(cache_key, asdict(classified))
+                classified_elements[i] = classified
             
-            classified_elements.append(classified)
+            self.cache.flush()
+        
+        # Remember the whole document (not when extraction came back empty, and
+        # not when some elements only have fallback defaults: retry those next run)
+        if fallbacks:
+            logger.info(f"{fallbacks} elements fell back to defaults, document not cached")
+        elif classified_elements:
+            self.cache.set_document(doc_key, [asdict(classified) for classified in classified_elements])
         
         return classified_elements
     
+    def _classified_from_cache(self, cached: Dict) -> ClassifiedElement:
+        """Rebuild a ClassifiedElement from its cached dict"""
+        # Convert tag_type string back to TagType enum
+        if isinstance(cached.get('tag_type'), str):
+            cached['tag_type'] = TAG_TYPE_BY_VALUE.get(cached['tag_type']) or TagType(cached['tag_type'])
+        # asdict() flattened the dataclasses; rebuild them so output matches a fresh run
+        attrs = cached.get('attributes')
+        if isinstance(attrs, dict):
+            cached['attributes'] = StructureAttributes(**{
+                k: v for k, v in attrs.items() if k in _ATTRIBUTE_FIELDS
+            })
+        if cached.get('children'):
+            cached['children'] = [self._classified_from_cache(child) for child in cached['children']]
+        return ClassifiedElement(**cached)
+    
     def _extract_elements(self, pdf_path: str) -> List[ExtractedElement]:
         """Extract all elements from PDF"""
+        import pymupdf  # PyMuPDF (fitz)
+        
         elements = []
         
         try:
-            with pdfplumber.open(pdf_path) as pdf:
-                for page_num, page in enumerate(pdf.pages, start=1):
-                    logger.info(f"Processing page {page_num}")
-                    
-                    # Extract text line by line  
-                    text = page.extract_text()
-                    if text:
-                        lines = text.split('\n')
-                        logger.info(f"Extracted {len(lines)} lines from page {page_num}")
-                        current_para = ""
+            with pymupdf.open(pdf_path) as doc:
+                page_count = doc.page_count
+                results = None
+                
+                # Large documents: contiguous page ranges extracted in worker processes
+                workers = min(os.cpu_count() or 1, page_count)
+                if page_count >= _PARALLEL_MIN_PAGES and workers > 1:
+                    try:
+                        step = -(-page_count // workers)
+                        starts = list(range(0, page_count, step))
+                        stops = [min(start + step, page_count) for start in starts]
+                        with ProcessPoolExecutor(max_workers=len(starts)) as executor:
+                            results = list(executor.map(_extract_page_range, [pdf_path] * len(starts), starts, stops))
+                    except Exception as e:
+                        logger.warning(f"Parallel extraction failed, continuing serially: {e}")
+                
+                if results is not None:
+                    # Ranges come back in page order
+                    elements = [element for page_range in results for element in page_range]
+                else:
+                    for page_num, page in enumerate(doc, start=1):
+                        elements.extend(self._extract_page(page, page_num))
+            
+            logger.info(f"Extracted {len(elements)} elements")
+            
+        except Exception as e:
+            logger.error(f"Error extracting: {e}")
+        
+        return elements
+    
+    @classmethod
+    def _extract_page(cls, page, page_num: int) -> List[ExtractedElement]:
+        """Extract the elements of one page (page_num is 1-based)"""
+        elements = []
+        
+        logger.debug("Processing page %d", page_num)
+        
+        # Extract text line by line, block by block. MuPDF already groups
+        # lines into blocks, so a blank line after each block ends the paragraph.
+        lines = []
+        for block in page.get_text("blocks"):
+            if block[6] == 0:  # Text block (1 = image block)
+                lines.extend(block[4].split('\n'))
+                lines.append('')
+        
+        if lines:
+            logger.debug("Extracted %d lines from page %d", len(lines), page_num)
+            current_para = ""
+            
+            for line_idx, line in enumerate(lines):
+                line = line.strip()
+                if not line:
+                    # Empty line - process accumulated paragraph
+                    if current_para and len(current_para) > 5:
+                        is_heading = cls._is_heading(current_para)
+                        is_list_item = cls._is_list_item(current_para)
                         
-                        for line_idx, line in enumerate(lines):
-                            line = line.strip()
-                            if not line:
-                                # Empty line - process accumulated paragraph
-                                if current_para and len(current_para) > 5:
-                                    is_heading = self._is_heading(current_para)
-                                    is_list_item = self._is_list_item(current_para)
-                                    
-                                    if is_list_item:
-                                        # Extract individual list items
-                                        list_items = self._extract_list_items(current_para)
-                                        for item in list_items:
-                                            elements.append(ExtractedElement(
-                                                content=item,
-                                                detected_type="list_item",
-                                                page=page_num,
-                                                metadata={"original_text": item}
-                                            ))
-                                    else:
-                                        elements.append(ExtractedElement(
-                                            content=current_para,
-                                            detected_type="heading" if is_heading else "paragraph",
-                                            page=page_num,
-                                            metadata={"original_text": current_para}
-                                        ))
-                                    current_para = ""
-                                continue
-                            
-                            # Check if this line is a list item on its own
-                            if self._is_list_item(line):
-                                # Save current para if exists
-                                if current_para:
-                                    elements.append(ExtractedElement(
-                                        content=current_para,
-                                        detected_type="heading" if self._is_heading(current_para) else "paragraph",
-                                        page=page_num,
-                                        metadata={"original_text": current_para}
-                                    ))
-                                    current_para = ""
-                                
-                                # Process the list item
+                        if is_list_item:
+                            # Extract individual list items
+                            list_items = cls._extract_list_items(current_para)
+                            for item in list_items:
                                 elements.append(ExtractedElement(
-                                    content=line,
+                                    content=item,
                                     detected_type="list_item",
                                     page=page_num,
-                                    metadata={"original_text": line}
+                                    metadata={"original_text": item}
                                 ))
-                            else:
-                                # Accumulate into paragraph
-                                if current_para:
-                                    current_para += " " + line
-                                else:
-                                    current_para = line
-                        
-                        # Process any remaining paragraph
-                        if current_para and len(current_para) > 5:
-                            is_heading = self._is_heading(current_para)
-                            is_list_item = self._is_list_item(current_para)
-                            
-                            if is_list_item:
-                                list_items = self._extract_list_items(current_para)
-                                for item in list_items:
-                                    elements.append(ExtractedElement(
-                                        content=item,
-                                        detected_type="list_item",
-                                        page=page_num,
-                                        metadata={"original_text": item}
-                                    ))
-                            else:
-                                elements.append(ExtractedElement(
-                                    content=current_para,
-                                    detected_type="division" if is_heading else "paragraph",
-                                    page=page_num,
-                                    metadata={"original_text": current_para}
-                                ))
-                    
-                    # Extract tables
-                    tables = page.extract_tables()
-                    for table in tables:
-                        if table:
-                            table_str = self._table_to_string(table)
+                        else:
                             elements.append(ExtractedElement(
-                                content=table_str,
-                                detected_type="table",
+                                content=current_para,
+                                detected_type="heading" if is_heading else "paragraph",
                                 page=page_num,
-                                metadata={"table": table}
+                                metadata={"original_text": current_para}
                             ))
+                        current_para = ""
+                    continue
+                
+                # Check if this line is a list item on its own
+                if cls._is_list_item(line):
+                    # Save current para if exists
+                    if current_para:
+                        elements.append(ExtractedElement(
+                            content=current_para,
+                            detected_type="heading" if cls._is_heading(current_para) else "paragraph",
+                            page=page_num,
+                            metadata={"original_text": current_para}
+                        ))
+                        current_para = ""
+                    
+                    # Process the list item
+                    elements.append(ExtractedElement(
+                        content=line,
+                        detected_type="list_item",
+                        page=page_num,
+                        metadata={"original_text": line}
+                    ))
+                else:
+                    # Accumulate into paragraph
+                    if current_para:
+                        current_para += " " + line
+                    else:
+                        current_para = line
             
-            logger.info(f"Extracted {len(elements)} elements")
-            
-        except Exception as e:
-            logger.error(f"Error extracting: {e}")
+            # Process any remaining paragraph
+            if current_para and len(current_para) > 5:
+                is_heading = cls._is_heading(current_para)
+                is_list_item = cls._is_list_item(current_para)
+                
+                if is_list_item:
+                    list_items = cls._extract_list_items(current_para)
+                    for item in list_items:
+                        elements.append(ExtractedElement(
+                            content=item,
+                            detected_type="list_item",
+                            page=page_num,
+                            metadata={"original_text": item}
+                        ))
+                else:
+                    elements.append(ExtractedElement(
+                        content=current_para,
+                        detected_type="division" if is_heading else "paragraph",
+                        page=page_num,
+                        metadata={"original_text": current_para}
+                    ))
+        
+        # Extract tables (rows of cell strings, None for empty cells)
+        tables = [table.extract() for table in page.find_tables().tables]
+        for table in tables:
+            if table:
+                table_str = cls._table_to_string(table)
+                elements.append(ExtractedElement(
+                    content=table_str,
+                    detected_type="table",
+                    page=page_num,
+                    metadata={"table": table}
+                ))
         
         return elements
     
-    def _is_heading(self, text: str) -> bool:
+    @staticmethod
+    def _is_heading(text: str) -> bool:
         """Check if text is a heading"""
         text_stripped = text.strip()
         
+        # Cheap rejections first: long paragraphs and lowercase starts are never headings
+        if not text_stripped or len(text_stripped) > 120:
+            return False
+        first = text_stripped[0]
+        if first.islower():
+            return False
+        
         # Short text is likely a heading
         if len(text_stripped) < 100 and text_stripped.isupper():
             return True
         
-        # Check for heading patterns
-        import re
-        if re.match(r'^\d+[\.\)]\s+[A-Z]', text_stripped):
-            return True
-        if re.match(r'^[A-Z][A-Z\s]{5,}$', text_stripped):
-            return True
-        
-        return False
+        # Check for heading patterns (they start with a digit or an ASCII capital)
+        if not (first.isdecimal() or 'A' <= first <= 'Z'):
+            return False
+        return _HEADING_RE.match(text_stripped) is not None
     
-    def _is_list_item(self, text: str) -> bool:
+    @staticmethod
+    def _is_list_item(text: str) -> bool:
         """Check if text is a list item"""
         text_stripped = text.strip()
         
+        if not text_stripped:
+            return False
+        
+        # Dispatch on the first character; most lines fail here without a regex
+        first = text_stripped[0]
+        
         # Check for bullet points
-        bullet_chars = ['•', '▪', '▫', '‣', '⁃', '◦', '○', '●', '\u2022']
-        if text_stripped and text_stripped[0] in bullet_chars:
+        if first in _BULLET_SET:
             return True
         
-        # Check for numbered lists
-        import re
-        if re.match(r'^\d+[\.\)]\s+', text_stripped):
-            return True
+        # Check for numbered lists: digits, then '.' or ')', then whitespace
+        if first.isdecimal():
+            i = 1
+            length = len(text_stripped)
+            while i < length and text_stripped[i].isdecimal():
+                i += 1
+            return i + 1 < length and text_stripped[i] in '.)' and text_stripped[i + 1].isspace()
         
         # Check for lettered lists
-        if re.match(r'^[a-z][\.\)]\s+', text_stripped):
+        if (first in _LIST_LETTERS and len(text_stripped) > 2 and
+                text_stripped[1] in '.)' and text_stripped[2].isspace()):
             return True
         
         # Check for Roman numerals
-        if re.match(r'^[ivxlcdm]+[\.\)]\s+', text_stripped, re.IGNORECASE):
-            return True
+        if first in _ROMAN_LETTERS:
+            return _LIST_ROMAN_RE.match(text_stripped) is not None
         
         return False
     
-    def _extract_list_items(self, text: str) -> list:
+    @staticmethod
+    def _extract_list_items(text: str) -> list:
         """Extract individual list items from text"""
-        import re
         
-        # Split by bullets
+        # Split by bullets: map every bullet to one separator, then split once
         items = []
-        bullet_chars = ['•', '▪', '▫', '‣', '⁃', '◦', '○', '●', '\u2022']
-        
-        for bullet in bullet_chars:
-            parts = text.split(bullet)
-            if len(parts) > 1:
-                for part in parts:
-                    part = part.strip()
-                    if part:
-                        # Remove leading numbering if present
-                        part = re.sub(r'^\d+[\.\)]\s+', '', part)
-                        part = re.sub(r'^[a-z][\.\)]\s+', '', part)
-                        part = re.sub(r'^[ivxlcdm]+[\.\)]\s+', '', part, flags=re.IGNORECASE)
-                        items.append(part)
-                break
+        
+        parts = text.translate(_BULLET_TRANS).split(_BULLET_SEP)
+        if len(parts) > 1:
+            for part in parts:
+                part = part.strip()
+                if part:
+                    # Remove leading numbering if present
+                    part = _LIST_NUM_RE.sub('', part)
+                    part = _LIST_ALPHA_RE.sub('', part)
+                    part = _LIST_ROMAN_RE.sub('', part)
+                    items.append(part)
         
         # If no bullets found, try numbered lists
         if not items:
-            numbered = re.split(r'\n\s*\d+[\.\)]\s+', text)
+            numbered = _LIST_SPLIT_RE.split(text)
             items = [item.strip() for item in numbered if item.strip()]
         
         # If still no items, return as single item
@@ -506,12 +1020,20 @@ class ExpertPDFTagger:
         
         return items
     
-    def _table_to_string(self, table: List[List]) -> str:
+    @staticmethod
+    def _table_to_string(table: List[List]) -> str:
         """Convert table to string"""
         return "\n".join(["\t".join([str(cell) if cell else "" for cell in row]) for row in table])
     
-    def apply_tags_to_pdf(self, input_pdf: str, output_pdf: str, elements: List[ClassifiedElement]):
-        """Apply structure tags to PDF and save"""
+    def apply_tags_to_pdf(self, input_pdf: str, output_pdf: str, elements: List[ClassifiedElement],
+                          save_json: bool = True, aggressive_cleanup: bool = False) -> Dict:
+        """
+        Apply structure tags to PDF and save, returning the structure tags document
+        
+        Only catalog and metadata entries change, so the save does a light
+        garbage pass by default; aggressive_cleanup=True restores the full
+        object-graph collection and content-stream cleaning.
+        """
         logger.info(f"Applying tags to PDF: {input_pdf}")
         
         # Create output directory if it doesn't exist
@@ -519,6 +1041,8 @@ class ExpertPDFTagger:
         output_dir.mkdir(exist_ok=True)
         
         # Open PDF
+        import pymupdf  # PyMuPDF (fitz)
+        
         doc = pymupdf.open(input_pdf)
         
         try:
@@ -547,17 +1071,23 @@ class ExpertPDFTagger:
             except Exception as e:
                 logger.debug(f"Could not mark document: {e}")
             
-            # Save tagged PDF
-            doc.save(output_pdf, garbage=4, deflate=True, use_objstms=False, clean=True)
+            # Save tagged PDF (object streams pack the many small structure dicts together)
+            if aggressive_cleanup:
+                doc.save(output_pdf, garbage=4, deflate=True, use_objstms=True, clean=True)
+            else:
+                doc.save(output_pdf, garbage=1, deflate=True, use_objstms=True, clean=False)
             logger.info(f"Tagged PDF saved to: {output_pdf}")
             
         finally:
             doc.close()
         
+        if not save_json:
+            return self.build_tags_document(elements)
+        
         # Save tags to JSON in cache folder
         json_filename = Path(output_pdf).stem + '_tags.json'
         json_output = Path("accessibility_cache") / json_filename
-        self.save_tags_json(elements, str(json_output))
+        return self.save_tags_json(elements, str(json_output))
     
     def _embed_structure_tree(self, doc, elements: List[ClassifiedElement]):
         """Embed actual PDF structure tags into the PDF"""
@@ -609,23 +1139,22 @@ class ExpertPDFTagger:
             }
             
             # Group elements by page
-            pages_elements = {}
+            pages_elements = defaultdict(list)
             for element in elements:
-                page = element.page - 1
-                if page not in pages_elements:
-                    pages_elements[page] = []
-                pages_elements[page].append(element)
+                pages_elements[element.page - 1].append(element)
             
-            # Create structure elements for each page
+            # Create structure elements for each page, in page order
             page_refs = []
-            for page_num, page_elements in pages_elements.items():
-                if page_num < doc.page_count:
-                    page = doc[page_num]
-                    
-                    # Create page structure element
-                    for element in page_elements:
-                        struct_dict = self._create_structure_element(doc, element, page)
-                        page_refs.append(struct_dict)
+            page_count = doc.page_count
+            for page_num in sorted(pages_elements):
+                if page_num >= page_count:
+                    break
+                page = doc[page_num]
+                
+                # Create page structure element
+                for element in pages_elements[page_num]:
+                    struct_dict = self._create_structure_element(doc, element, page)
+                    page_refs.append(struct_dict)
             
             # Set up the document's structure tree
             # This is complex PDF internals manipulation
@@ -633,10 +1162,7 @@ class ExpertPDFTagger:
                 # Add to document catalog
                 catalog = doc.get_pdf_catalog()
                 
-                # Mark document as tagged
-                catalog['MarkInfo'] = {'Marked': 'true'}
-                
-                # Create structure tree root
+                # Create structure tree root (MarkInfo is set once by apply_tags_to_pdf)
                 if 'StructTreeRoot' not in catalog:
                     struct_tree_root = {
                         'Type': '/StructTreeRoot',
@@ -658,7 +1184,7 @@ class ExpertPDFTagger:
         # Create structure element dict
         struct_elem = {
             'Type': '/StructElem',
-            'S': f'/{element.tag_type.value}',  # Structure type (tag)
+            'S': _S_NAMES[element.tag_type],  # Structure type (tag)
             'P': None,  # Parent (will be set)
             'Page': None,  # Page reference (will be set)
             'K': []  # Kids
@@ -685,7 +1211,7 @@ class ExpertPDFTagger:
             # For now, we'll add as content stream comment
             # which shows structure information
             
-            logger.debug(f"Added structure mark for {element.tag_type.value} on page {element.page}")
+            logger.debug("Added structure mark for %s on page %d", element.tag_type.value, element.page)
             
         except Exception as e:
             logger.debug(f"Could not add structure mark: {e}")
@@ -723,8 +1249,19 @@ class ExpertPDFTagger:
         except Exception as e:
             logger.debug(f"Error adding to existing structure: {e}")
     
-    def save_tags_json(self, elements: List[ClassifiedElement], json_path: str):
-        """Save structure tags to JSON"""
+    def save_tags_json(self, elements: List[ClassifiedElement], json_path: str) -> Dict:
+        """Save structure tags to JSON and return the saved document"""
+        tags_data = self.build_tags_document(elements)
+        
+        with open(json_path, 'wb') as f:
+            f.write(json_dumps(tags_data, indent=True))
+        
+        logger.info(f"Saved {len(elements)} structure tags to {json_path}")
+        
+        return tags_data
+    
+    def build_tags_document(self, elements: List[ClassifiedElement]) -> Dict:
+        """Build the structure tags document written by save_tags_json"""
         # Convert to dict format for JSON
         tags_data = {
             "document": {
@@ -759,47 +1296,102 @@ class ExpertPDFTagger:
             
             tags_data["document"]["structure_tags"].append(tag_dict)
         
-        with open(json_path, 'w') as f:
-            json.dump(tags_data, f, indent=2)
+        # Summary written once here so readers don't have to recount the tags
+        tags = tags_data["document"]["structure_tags"]
+        tags_data["document"]["stats"] = {
+            "tag_counts": dict(Counter(tag["type"] for tag in tags)),
+            "total": len(tags)
+        }
         
-        logger.info(f"Saved {len(elements)} structure tags to {json_path}")
+        return tags_data
 
 
-def main():
-    """Main entry point"""
-    import argparse
+def _extract_page_range(pdf_path: str, start: int, stop: int) -> List[ExtractedElement]:
+    """Extract elements from pages [start, stop) of a PDF (process pool worker)"""
+    import pymupdf  # PyMuPDF (fitz)
     
-    parser = argparse.ArgumentParser(description="Expert PDF Accessibility Tagger")
-    parser.add_argument("input_pdf", help="Input PDF file")
-    parser.add_argument("output_name", help="Output PDF name (without .pdf)")
-    parser.add_argument("--api-key", default=os.getenv("GEMINI_API_KEY"), 
-                       help="Gemini API key")
-    parser.add_argument("--model", default="gemini-2.5-flash", 
-                       help="Model name")
+    elements = []
+    with pymupdf.open(pdf_path) as doc:
+        for page_index in range(start, stop):
+            elements.extend(ExpertPDFTagger._extract_page(doc[page_index], page_index + 1))
+    return elements
+
+
+def generate_tags(input_pdf: str, output_name: str, api_key: Optional[str] = None,
+                  model: str = "gemini-2.5-flash", save_json: bool = False,
+                  aggressive_cleanup: bool = False, llm_all: bool = False) -> Dict:
+    """
+    Tag a PDF with the expert tagger and return the structure tags document.
     
-    args = parser.parse_args()
+    Writes output/<output_name>.pdf; with save_json=True (as the CLI does)
+    also accessibility_cache/<output_name>_tags.json. Library callers get
+    the document back and usually don't need the file.
     
-    if not args.api_key:
-        logger.error("No API key provided")
-        return
+    Args:
+        input_pdf: Path to input PDF
+        output_name: Output PDF name (without .pdf)
+        api_key: Gemini API key (defaults to GEMINI_API_KEY)
+        model: Model name
+        save_json: Also write the tags JSON file
+        aggressive_cleanup: Full garbage collection and stream cleaning on save
+        llm_all: Generate attributes with the LLM for every element, not only
+            figures, tables, formulas, titles, links and form fields
+    
+    Returns:
+        Dict: Structure tags document, same layout as the JSON file
+    """
+    api_key = api_key or os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        raise ValueError("No API key provided")
     
     # Create output directory
     output_dir = Path("output")
     output_dir.mkdir(exist_ok=True)
     
     # Output PDF path
-    output_pdf = output_dir / f"{args.output_name}.pdf"
+    output_pdf = output_dir / f"{output_name}.pdf"
     
     # Initialize tagger
-    tagger = ExpertPDFTagger(args.api_key, args.model)
+    tagger = ExpertPDFTagger(api_key, model, llm_all)
     
-    # Extract and classify
-    elements = tagger.extract_and_classify(args.input_pdf)
+    # Extract and classify (the cache isn't needed after this)
+    try:
+        elements = tagger.extract_and_classify(input_pdf)
+    finally:
+        tagger.cache.close()
     
     # Apply tags to PDF
-    tagger.apply_tags_to_pdf(args.input_pdf, str(output_pdf), elements)
+    tags_data = tagger.apply_tags_to_pdf(input_pdf, str(output_pdf), elements, save_json,
+                                         aggressive_cleanup)
     
     logger.info(f"Done! Processed {len(elements)} elements. Tagged PDF saved to {output_pdf}")
+    
+    return tags_data
+
+
+def main():
+    """Main entry point"""
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Expert PDF Accessibility Tagger")
+    parser.add_argument("input_pdf", help="Input PDF file")
+    parser.add_argument("output_name", help="Output PDF name (without .pdf)")
+    parser.add_argument("--api-key", default=os.getenv("GEMINI_API_KEY"), 
+                       help="Gemini API key")
+    parser.add_argument("--model", default="gemini-2.5-flash", 
+                       help="Model name")
+    parser.add_argument("--aggressive-cleanup", action="store_true",
+                       help="Full garbage collection and content-stream cleaning when saving (slower)")
+    parser.add_argument("--llm-all", action="store_true",
+                       help="Ask the LLM for every element's attributes, not only those that need it")
+    
+    args = parser.parse_args()
+    
+    try:
+        generate_tags(args.input_pdf, args.output_name, args.api_key, args.model, save_json=True,
+                      aggressive_cleanup=args.aggressive_cleanup, llm_all=args.llm_all)
+    except ValueError as e:
+        logger.error(str(e))
 
 
 if __name__ == "__main__":
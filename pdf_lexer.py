@@ -0,0 +1,143 @@
+"""
+Minimal PDF Content Stream Lexer
+Delimiter-aware tokenizer for locating operators in content streams
+"""
+
+import re
+from enum import IntEnum
+from typing import Iterator, Tuple
+
+
+class TokenKind(IntEnum):
+    """Content stream token kinds"""
+    
+    OPERATOR = 1     # BT, ET, Tj, TJ, q, Q, ...
+    NUMBER = 2       # 12, -3.5, .25
+    NAME = 3         # /F1
+    STRING = 4       # (literal string), nesting and escapes handled
+    HEX_STRING = 5   # <48656C6C6F>
+    DELIMITER = 6    # [ ] { } << >>
+    KEYWORD = 7      # true, false, null
+    INLINE_DATA = 8  # raw image bytes between ID and EI
+
+
+# PDF whitespace characters
+_WHITESPACE = frozenset(b'\x00\t\n\f\r ')
+
+# Token table: one alternative per lexer state, compiled once.
+# Literal strings and inline image data are not regular, so they are
+# only detected here and scanned by hand below.
+_TOKEN_RE = re.compile(rb'''
+    (?P<ws>[\x00\t\n\f\r ]+)
+  | (?P<comment>%[^\r\n]*)
+  | (?P<dict><<|>>)
+  | (?P<hex><[^>]*>?)
+  | (?P<array>[\[\]{}])
+  | (?P<name>/[^\x00\t\n\f\r ()<>\[\]{}/%]*)
+  | (?P<string>\()
+  | (?P<regular>[^\x00\t\n\f\r ()<>\[\]{}/%]+)
+  | (?P<stray>.)
+''', re.VERBOSE | re.DOTALL)
+
+_NUMBER_RE = re.compile(rb'[+-]?(?:\d+\.?\d*|\.\d+)')
+_STRING_SPECIAL_RE = re.compile(rb'[()\\]')
+
+_KEYWORDS = frozenset((b'true', b'false', b'null'))
+
+
+def _scan_string(buf: bytes, pos: int) -> int:
+    """Return the offset just past the literal string whose body starts at pos"""
+    
+    depth = 1
+    search = _STRING_SPECIAL_RE.search
+    
+    while depth:
+        match = search(buf, pos)
+        if match is None:
+            return len(buf)  # Unterminated string runs to the end
+        
+        char = buf[match.start()]
+        pos = match.end()
+        
+        if char == 0x5C:  # Backslash escapes the next byte
+            pos += 1
+        elif char == 0x28:  # (
+            depth += 1
+        else:  # )
+            depth -= 1
+    
+    return pos
+
+
+def _scan_inline_data(buf: bytes, pos: int) -> int:
+    """Return the offset of the EI operator ending inline image data at pos"""
+    
+    while True:
+        ei = buf.find(b'EI', pos)
+        if ei < 0:
+            return len(buf)
+        
+        # EI must stand alone: whitespace before, whitespace or end after
+        if (buf[ei - 1] in _WHITESPACE and
+                (ei + 2 == len(buf) or buf[ei + 2] in _WHITESPACE)):
+            return ei
+        
+        pos = ei + 2
+
+
+def tokenize(buf: bytes) -> Iterator[Tuple[TokenKind, int, int]]:
+    """
+    Tokenize a content stream
+    
+    Yields (kind, start, end) byte offsets. Whitespace and comments are
+    skipped, so operator names that appear inside strings, names or
+    comments are never reported as operators.
+    """
+    
+    pos = 0
+    length = len(buf)
+    match_token = _TOKEN_RE.match
+    
+    while pos < length:
+        match = match_token(buf, pos)
+        group = match.lastgroup
+        start, end = match.span()
+        
+        if group == 'regular':
+            token = buf[start:end]
+            if _NUMBER_RE.fullmatch(token):
+                yield TokenKind.NUMBER, start, end
+            elif token in _KEYWORDS:
+                yield TokenKind.KEYWORD, start, end
+            else:
+                yield TokenKind.OPERATOR, start, end
+                
+                # Inline image: ID is followed by one whitespace byte and raw data up to EI
+                if token == b'ID':
+                    data_start = min(end + 1, length)
+                    end = _scan_inline_data(buf, data_start)
+                    yield TokenKind.INLINE_DATA, data_start, end
+        
+        elif group == 'name':
+            yield TokenKind.NAME, start, end
+        
+        elif group == 'string':
+            end = _scan_string(buf, end)
+            yield TokenKind.STRING, start, end
+        
+        elif group == 'hex':
+            yield TokenKind.HEX_STRING, start, end
+        
+        elif group in ('dict', 'array', 'stray'):
+            yield TokenKind.DELIMITER, start, end
+        
+        # ws and comment produce no tokens
+        pos = end
+
+
+def iter_operators(buf: bytes) -> Iterator[Tuple[bytes, int, int]]:
+    """Yield (operator, start, end) for every operator token in buf"""
+    
+    for kind, start, end in tokenize(buf):
+        if kind is TokenKind.OPERATOR:
+            yield buf[start:end], start, end
@@ -3,8 +3,10 @@ PDF Structure Taxonomy for PDF/UA compliance
 Implements the complete structure element taxonomy for accessible PDFs
 """
 
+import re
 from dataclasses import dataclass
-from typing import Optional, Dict, List
+from functools import lru_cache
+from typing import NamedTuple, Optional, Dict, List
 from enum import Enum
 
 
@@ -74,6 +76,10 @@ class TagType(Enum):
     RP = "RP"  # Ruby Pronunciation
 
 
+# Tag type by its string value, for deserializing without going through TagType()
+TAG_TYPE_BY_VALUE = {t.value: t for t in TagType}
+
+
 @dataclass
 class StructureAttributes:
     """Attributes for PDF structure elements"""
@@ -98,6 +104,10 @@ class StructureAttributes:
         return {k: v for k, v in self.__dict__.items() if v is not None}
 
 
+# Field names accepted by StructureAttributes(**...)
+_ATTRIBUTE_FIELDS = frozenset(StructureAttributes.__dataclass_fields__)
+
+
 @dataclass
 class StructureTag:
     """Represents a PDF structure tag with its properties"""
@@ -110,6 +120,23 @@ class StructureTag:
     
     def to_dict(self) -> Dict:
         """Convert to dictionary for JSON serialization"""
+        
+        # Walk the tree with an explicit stack so deep nesting never hits the
+        # recursion limit; each dict is placed in its parent's list when created
+        root = self._node_dict()
+        stack = [(self, root)]
+        
+        while stack:
+            tag, result = stack.pop()
+            if tag.children:
+                child_dicts = [child._node_dict() for child in tag.children]
+                result["children"].extend(child_dicts)
+                stack.extend(zip(tag.children, child_dicts))
+        
+        return root
+    
+    def _node_dict(self) -> Dict:
+        """This tag's dictionary, with an empty children list for to_dict to fill"""
         result = {
             "type": self.tag_type.value,
             "content": self.content,
@@ -119,7 +146,7 @@ class StructureTag:
             result["attributes"] = self.attributes.to_dict()
         
         if self.children:
-            result["children"] = [child.to_dict() for child in self.children]
+            result["children"] = []
         
         if self.page is not None:
             result["page"] = self.page
@@ -129,17 +156,33 @@ class StructureTag:
     @classmethod
     def from_dict(cls, data: Dict) -> 'StructureTag':
         """Create from dictionary"""
+        
+        # Same explicit-stack walk as to_dict
+        root = cls._from_node(data)
+        stack = [(data, root)]
+        
+        while stack:
+            node, tag = stack.pop()
+            if "children" in node:
+                tag.children = [cls._from_node(child) for child in node["children"]]
+                stack.extend(zip(node["children"], tag.children))
+        
+        return root
+    
+    @classmethod
+    def _from_node(cls, data: Dict) -> 'StructureTag':
+        """Create one tag from its dictionary, without children"""
         tag = cls(
-            tag_type=TagType(data["type"]),
+            tag_type=TAG_TYPE_BY_VALUE.get(data["type"]) or TagType(data["type"]),
             content=data["content"],
             page=data.get("page")
         )
         
         if "attributes" in data:
-            tag.attributes = StructureAttributes(**data["attributes"])
-        
-        if "children" in data:
-            tag.children = [cls.from_dict(child) for child in data["children"]]
+            # Unknown attribute keys are ignored rather than raising TypeError
+            tag.attributes = StructureAttributes(**{
+                k: v for k, v in data["attributes"].items() if k in _ATTRIBUTE_FIELDS
+            })
         
         return tag
 
@@ -158,8 +201,26 @@ class TaxonomyClassifier:
     LIST_INDICATORS = ['•', '▪', '‣', '-', '*', '○', '◦']
     NUMBERED_LIST_PATTERN = r'^\d+[\.\)]\s+'
     
+    FORMULA_PATTERNS = [
+        r'\$\$.*?\$\$',  # LaTeX block math
+        r'\$.*?\$',  # LaTeX inline math
+        r'\\\[.*?\\\]',  # LaTeX display
+        r'\\\(.*?\\\)',  # LaTeX inline
+        r'[A-Za-z]\s*[=<>]\s*[A-Za-z\d\s\+\-\*/\(\)]+',  # Equations
+    ]
+    
+    # Compiled once at class load; the heading patterns become one alternation
+    # (anchored, so order doesn't matter), formula patterns keep their priority order
+    HEADING_UNION = re.compile('|'.join(f'(?:{pattern})' for pattern in HEADING_PATTERNS))
+    NUMBERED_RE = re.compile(r'\d+[\.\)]\s+')
+    ALPHA_RE = re.compile(r'[a-z][\.\)]\s+', re.IGNORECASE)
+    FORMULA_REGEXES = [re.compile(pattern) for pattern in FORMULA_PATTERNS]
+    
     TABLE_INDICATORS = ['\t', '|', '---', '===']
     
+    # Heading level by word count (0-20 words); longer headings are level 6
+    HEADING_LEVEL_BY_WORDS = (2,) * 6 + (3,) * 5 + (4,) * 5 + (5,) * 5
+    
     # Mapping from generic types to specific taxonomy
     TYPE_MAPPING = {
         'paragraph': TagType.P,
@@ -197,17 +258,16 @@ class TaxonomyClassifier:
             return cls.TYPE_MAPPING[detected_type]
         
         # Auto-detect based on content
-        content_upper = content.upper().strip()
+        features = _analyze(content)
         
-        # Check for headings
-        if any(pattern.startswith('^') and len(content_upper.split()) <= 10 
-               for pattern in cls.HEADING_PATTERNS):
+        # Check for headings: short text matching one of the heading patterns
+        if features.word_count <= 10 and features.matches_heading:
             # Determine heading level
-            if content_upper.startswith('CHAPTER') or content_upper.startswith('PART'):
+            if features.starts_chapter:
                 return TagType.H1
-            elif content_upper.startswith('SECTION'):
+            elif features.starts_section:
                 return TagType.H2
-            elif len(content_upper) > 50:
+            elif len(features.upper) > 50:
                 return TagType.H6
             else:
                 return TagType.H1  # Default to H1
@@ -218,49 +278,43 @@ class TaxonomyClassifier:
     @classmethod
     def suggest_heading_level(cls, content: str, context: str = "") -> int:
         """Suggest heading level 1-6 based on content"""
-        content_upper = content.upper().strip()
-        word_count = len(content_upper.split())
+        features = _analyze(content)
+        word_count = features.word_count
         
-        if content_upper.startswith('CHAPTER') or content_upper.startswith('PART'):
+        if features.starts_chapter:
             return 1
-        elif content_upper.startswith('SECTION') or word_count <= 5:
+        elif features.starts_section:
             return 2
-        elif word_count <= 10 and content_upper.isupper():
-            return 3
-        elif word_count <= 15:
-            return 4
-        elif word_count <= 20:
-            return 5
-        else:
+        elif word_count >= len(cls.HEADING_LEVEL_BY_WORDS):
             return 6
+        
+        level = cls.HEADING_LEVEL_BY_WORDS[word_count]
+        
+        # Level 3 is only for capitalized headings; others drop to 4
+        if level == 3 and not features.upper.isupper():
+            return 4
+        return level
     
     @classmethod
     def classify_list_type(cls, content: str) -> Dict:
         """Classify list and determine if ordered or unordered"""
-        import re
         
         # Check for numbered items
-        if re.search(r'\d+[\.\)]\s+', content):
+        if cls.NUMBERED_RE.search(content):
             return {
                 "list_type": "ordered",
                 "style": "decimal"
             }
         
         # Check for lettered items
-        elif re.search(r'[a-z][\.\)]\s+', content, re.IGNORECASE):
+        elif cls.ALPHA_RE.search(content):
             return {
                 "list_type": "ordered",
                 "style": "alpha"
             }
         
-        # Check for bullet points
-        elif any(indicator in content for indicator in cls.LIST_INDICATORS):
-            return {
-                "list_type": "unordered",
-                "style": "disc"
-            }
-        
-        # Default to unordered
+        # Bullet points (LIST_INDICATORS) and everything else: unordered.
+        # Bullets give the same answer as the default, so no scan for them.
         return {
             "list_type": "unordered",
             "style": "disc"
@@ -275,10 +329,11 @@ class TaxonomyClassifier:
         headers = []
         has_header = False
         
-        # Check first row for headers (typically all caps or short phrases)
+        # Check first row for headers (typically all caps or short phrases).
+        # split(None, 5) stops after six words, enough to tell "at most five".
         first_row = table_data[0]
         if all(isinstance(cell, str) and 
-               (cell.isupper() or len(cell.split()) <= 5) 
+               (cell.isupper() or len(cell.split(None, 5)) <= 5) 
                for cell in first_row if cell):
             headers = first_row
             has_header = True
@@ -294,19 +349,10 @@ class TaxonomyClassifier:
     @classmethod
     def extract_formula(cls, content: str) -> Optional[Dict]:
         """Extract mathematical formula if present"""
-        import re
         
         # Look for common formula patterns
-        formula_patterns = [
-            r'\$\$.*?\$\$',  # LaTeX block math
-            r'\$.*?\$',  # LaTeX inline math
-            r'\\\[.*?\\\]',  # LaTeX display
-            r'\\\(.*?\\\)',  # LaTeX inline
-            r'[A-Za-z]\s*[=<>]\s*[A-Za-z\d\s\+\-\*/\(\)]+',  # Equations
-        ]
-        
-        for pattern in formula_patterns:
-            match = re.search(pattern, content)
+        for regex in cls.FORMULA_REGEXES:
+            match = regex.search(content)
             if match:
                 return {
                     "type": "Formula",
@@ -316,3 +362,25 @@ class TaxonomyClassifier:
         
         return None
 
+
+class _ContentFeatures(NamedTuple):
+    """Per-string facts shared by classify_content and suggest_heading_level"""
+    upper: str
+    word_count: int
+    starts_chapter: bool  # CHAPTER or PART
+    starts_section: bool
+    matches_heading: bool
+
+
+@lru_cache(maxsize=4096)
+def _analyze(content: str) -> _ContentFeatures:
+    """Analyze content once; repeated strings (and the second classifier call) hit the cache"""
+    content_stripped = content.strip()
+    content_upper = content_stripped.upper()
+    return _ContentFeatures(
+        upper=content_upper,
+        word_count=len(content_upper.split()),
+        starts_chapter=content_upper.startswith(('CHAPTER', 'PART')),
+        starts_section=content_upper.startswith('SECTION'),
+        matches_heading=TaxonomyClassifier.HEADING_UNION.match(content_stripped) is not None
+    )
@@ -0,0 +1,45 @@
+"""
+Structure Tags JSON I/O
+Fast JSON encoding/decoding for structure tags files
+"""
+
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+# Fastest available JSON decoder: orjson, then ujson, then the stdlib
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    try:
+        from ujson import loads as json_loads
+    except ImportError:
+        from json import loads as json_loads
+
+# Encoder: orjson when available, otherwise the stdlib; both return UTF-8 bytes
+try:
+    import orjson
+    
+    def json_dumps(obj: Any, indent: bool = False, default: Optional[Callable] = None) -> bytes:
+        """Serialize obj to JSON bytes (indent=True for 2-space pretty printing)"""
+        return orjson.dumps(obj, default=default, option=orjson.OPT_INDENT_2 if indent else 0)
+    
+except ImportError:
+    import json
+    
+    def json_dumps(obj: Any, indent: bool = False, default: Optional[Callable] = None) -> bytes:
+        """Serialize obj to JSON bytes (indent=True for 2-space pretty printing)"""
+        return json.dumps(obj, indent=2 if indent else None, default=default,
+                          ensure_ascii=False).encode('utf-8')
+
+
+def load_tags_json(json_tags_file: str) -> Dict:
+    """
+    Load a structure tags JSON file.
+    
+    Args:
+        json_tags_file: Path to the tags JSON file
+    
+    Returns:
+        Dict: Parsed tags document
+    """
+    return json_loads(Path(json_tags_file).read_bytes())
@@ -0,0 +1,93 @@
+"""
+Document cache round trip: a second run over the same PDF must give the same tags
+"""
+
+import json
+import sys
+import tempfile
+import types
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import expert_pdf_tagger
+from expert_pdf_tagger import ExpertPDFTagger, ExtractedElement, IntelligentCache
+
+
+class _FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class _FakeModel:
+    """Stands in for genai.GenerativeModel: one fixed answer per prompt"""
+
+    calls = 0
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def generate_content(self, prompt, generation_config=None):
+        _FakeModel.calls += 1
+        return _FakeResponse(json.dumps({
+            "alt": "Bar chart", "lang": "en", "title": "Sales chart", "summary": "Quarterly sales"
+        }))
+
+
+def _fake_genai():
+    genai = types.ModuleType("google.generativeai")
+    genai.configure = lambda **kwargs: None
+    genai.GenerativeModel = _FakeModel
+    google = types.ModuleType("google")
+    google.generativeai = genai
+    return {"google": google, "google.generativeai": genai}
+
+
+ELEMENTS = [
+    ExtractedElement(content="INTRODUCTION", detected_type="h1", page=1),
+    ExtractedElement(content="Revenue grew 12% year over year.", detected_type="paragraph", page=1),
+    ExtractedElement(content="Figure 1: Quarterly sales", detected_type="figure", page=2),
+]
+
+
+class DocumentCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+        self.pdf_path = self.tmp / "doc.pdf"
+        self.pdf_path.write_bytes(b"%PDF-1.7 test document")
+
+        patcher = mock.patch.dict(sys.modules, _fake_genai())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        _FakeModel.calls = 0
+
+    def _run(self):
+        cache = IntelligentCache(self.tmp / "cache")
+        with mock.patch.object(expert_pdf_tagger, "IntelligentCache", lambda: cache):
+            tagger = ExpertPDFTagger("test-key")
+        tagger._extract_elements = lambda pdf_path: list(ELEMENTS)
+        try:
+            elements = tagger.extract_and_classify(str(self.pdf_path))
+        finally:
+            cache.close()
+
+        document = tagger.build_tags_document(elements)
+        del document["document"]["created"]
+        return document
+
+    def test_document_cache_hit_gives_same_tags(self):
+        first = self._run()
+        calls = _FakeModel.calls
+        second = self._run()
+
+        self.assertEqual(_FakeModel.calls, calls, "second run should be served from the document cache")
+        self.assertEqual(first, second)
+
+
+if __name__ == "__main__":
+    unittest.main()